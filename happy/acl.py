@@ -1,6 +1,18 @@
 """
 Implements acl based security.  Largely ripped off from repoze.bfg.
+
+Permission checks made with `has_permission` are cached for the duration of
+a request, keyed by permission and context, since rendering a single page
+might check the same permission on the same context many times.  A request's
+effective principals are also only computed once.  Changing the request's
+`remote_user`, assigning a new list of `authenticated_principals` or
+assigning a new `__acl__` to the context or one of its ancestors invalidates
+cached checks.  Code which modifies an `__acl__` or the list of
+`authenticated_principals` in place during a request should call
+`forget_permissions` before checking permissions again.
 """
+import threading
+
 from webob.exc import HTTPForbidden
 from webob.exc import HTTPUnauthorized
 
@@ -26,15 +38,63 @@ def may(principals, permission, context):
     Returns boolean indicating whether user with given principals has given
     permission on the given context.
     """
-    for node in _lineage(context):
-        acl = getattr(node, '__acl__', None)
+    return _may(principals, permission, _acls(context))
+
+def _may(principals, permission, acls):
+    for acl in acls:
         if acl is None:
             continue
 
+        if isinstance(acl, CompiledACL):
+            for access, principal in acl.entries(permission):
+                if principal in principals:
+                    return access == Allow
+            continue
+
         for access, principal, permissions in acl:
             if principal in principals and permission in permissions:
                 return access == Allow
 
+def compile_acl(acl):
+    """
+    Compiles an ACL for faster permission checks.  The compiled ACL may be
+    used in place of the original as a model's `__acl__`::
+
+        context.__acl__ = compile_acl([
+            (Allow, 'group.Admin', ALL_PERMISSIONS),
+            (Allow, Everyone, ['view']),
+        ])
+
+    See `CompiledACL`.
+    """
+    return CompiledACL(acl)
+
+class CompiledACL(tuple):
+    """
+    An immutable ACL which indexes its entries by permission.  The first
+    time a permission is checked against the ACL, the entries which grant
+    or deny that permission are found and remembered, so subsequent checks
+    only need to consider the entries relevant to the permission being
+    checked.  A compiled ACL is a tuple of entries and can be iterated over
+    like any other ACL.
+    """
+    def __init__(self, acl):
+        self._entries = {}
+
+    def entries(self, permission):
+        """
+        Returns, in order, the `(access, principal)` pairs of the entries
+        which apply to `permission`.
+        """
+        entries = self._entries.get(permission)
+        if entries is None:
+            entries = self._entries[permission] = tuple([
+                (access, principal)
+                for access, principal, permissions in self
+                if permission in permissions
+            ])
+        return entries
+
 def effective_principals(request):
     principals = getattr(request, 'authenticated_principals', [])
     effective_principals = [Everyone] + principals
@@ -45,39 +105,444 @@ def effective_principals(request):
 def has_permission(request, permission, context=None):
     if context is None:
         context = getattr(request, 'context', None)
-    return may(effective_principals(request), permission, context)
+
+    cache = _permission_cache(request)
+    acls = _acls(context)
+    key = (permission, id(context), tuple(map(id, acls)))
+    decision = cache.decisions.get(key)
+    if decision is not None:
+        return decision[-1]
+
+    allowed = _may(cache.principals, permission, acls)
+    # The context and acls are kept in the cache so that their ids can't be
+    # reused by other objects during the request.
+    cache.decisions[key] = (context, acls, allowed)
+    return allowed
+
+def filter_permitted(request, permission, contexts):
+    """
+    Generates the subset of `contexts` on which the request has
+    `permission`.  Useful for listing views which hide items the user isn't
+    allowed to see.  Equivalent to calling `has_permission` for each
+    context, except that the decision for each ancestor is remembered, so
+    the ACLs of a folder and its ancestors are only evaluated once for all
+    of the folder's children and only each child's own `__acl__` need be
+    evaluated.
+    """
+    principals = _permission_cache(request).principals
+    memo = {}
+    for context in contexts:
+        if _memoized_may(principals, permission, context, memo):
+            yield context
+
+def _memoized_may(principals, permission, context, memo):
+    # Find the nearest ancestor with a known decision
+    allowed = None
+    unknown = []
+    node = context
+    while node is not None:
+        known = memo.get(id(node))
+        if known is not None:
+            allowed = known[1]
+            break
+        unknown.append(node)
+        node = getattr(node, '__parent__', None)
+
+    # The decision for a node is made by its own ACL if any of its entries
+    # apply, otherwise it is the decision for its parent.  Nodes are kept in
+    # the memo so that their ids can't be reused by other objects.
+    for node in reversed(unknown):
+        acl = getattr(node, '__acl__', None)
+        if acl is not None:
+            decision = _may(principals, permission, (acl,))
+            if decision is not None:
+                allowed = decision
+        memo[id(node)] = (node, allowed)
+
+    return allowed
+
+def forget_permissions(request):
+    """
+    Clears the cache of permission checks made for this request.
+    """
+    request.environ.pop('happy.acl', None)
+
+def _permission_cache(request):
+    environ = request.environ
+    authenticated = getattr(request, 'authenticated_principals', None)
+    remote_user = request.remote_user
+    cache = environ.get('happy.acl')
+    if (cache is None or cache.authenticated is not authenticated or
+        cache.remote_user != remote_user):
+        # Replace, rather than update, the cache, since the environ might be
+        # a shallow copy of another request's environ.
+        cache = environ['happy.acl'] = _PermissionCache(
+            frozenset(effective_principals(request)), authenticated,
+            remote_user
+        )
+    return cache
+
+class _PermissionCache(object):
+    def __init__(self, principals, authenticated, remote_user):
+        self.principals = principals
+        self.authenticated = authenticated
+        self.remote_user = remote_user
+        self.decisions = {}
+
+class ACLIndex(object):
+    """
+    An index of the effective ACL of each model in an object graph, that is,
+    the entries of the model's own `__acl__` followed by the entries of its
+    ancestors' ACLs, in the order that `may` would consider them.  Once a
+    model is indexed, checking a permission on it with the index's `may`
+    method doesn't need to walk `__parent__` at all, and only the entries of
+    the effective ACL which apply to the permission being checked are
+    considered.
+
+    Models are indexed lazily, the first time they are checked, and share the
+    indexed effective ACLs of their ancestors when they are indexed.  The
+    index holds references to indexed models and can't know when an
+    `__acl__` is changed or a model is moved, so applications which use an
+    index must call `invalidate` when that happens.
+    """
+    def __init__(self):
+        self._index = {}
+        self._children = {}
+
+    def may(self, principals, permission, context):
+        """
+        Same as `happy.acl.may`, but consults the index.
+        """
+        for access, principal in self.effective_acl(context).entries(
+            permission):
+            if principal in principals:
+                return access == Allow
+
+    def effective_acl(self, context):
+        """
+        Returns the effective ACL of `context`, as a `CompiledACL`, indexing
+        it and its ancestors first, if need be.
+        """
+        index = self._index
+        entry = index.get(id(context))
+        if entry is not None:
+            return entry[1]
+
+        # Find the nearest indexed ancestor
+        effective = _empty_acl
+        unindexed = []
+        node = context
+        while node is not None:
+            entry = index.get(id(node))
+            if entry is not None:
+                effective = entry[1]
+                break
+            unindexed.append(node)
+            node = getattr(node, '__parent__', None)
+
+        # Index from the top down.  Models are kept in the index so that
+        # their ids can't be reused by other objects while they are indexed.
+        children = self._children
+        for node in reversed(unindexed):
+            acl = getattr(node, '__acl__', None)
+            if acl:
+                effective = _merge_acls(acl, effective)
+            parent_id = id(getattr(node, '__parent__', None))
+            index[id(node)] = (node, effective, parent_id)
+            children.setdefault(parent_id, set()).add(id(node))
+
+        return effective
+
+    def invalidate(self, context=None):
+        """
+        Removes `context` and all of its indexed descendants from the index,
+        so that their effective ACLs are computed again the next time they
+        are checked.  Call when the `__acl__` of a model changes, or when a
+        model is moved, before moving it.  If no context is given, the index
+        is cleared.
+        """
+        if context is None:
+            self._index.clear()
+            self._children.clear()
+            return
+
+        index = self._index
+        children = self._children
+        entry = index.get(id(context))
+        if entry is not None:
+            siblings = children.get(entry[2])
+            if siblings is not None:
+                siblings.discard(id(context))
+
+        invalid = [id(context)]
+        while invalid:
+            node_id = invalid.pop()
+            index.pop(node_id, None)
+            invalid.extend(children.pop(node_id, ()))
+
+_empty_acl = CompiledACL(())
+
+def _merge_acls(acl, inherited):
+    """
+    Returns a compiled ACL with the entries of `acl` followed by the entries
+    of `inherited`, omitting any entry which is identical to an earlier
+    entry, since such an entry can never be the first to apply.
+    """
+    own = []
+    for ace in acl:
+        if ace not in own:
+            own.append(ace)
+    # The inherited ACL has already been merged, so only needs to be checked
+    # against the model's own, typically short, ACL.
+    return CompiledACL(own + [ace for ace in inherited if ace not in own])
+
+class ACLBits(object):
+    """
+    Speeds up permission checks in applications with a fixed set of
+    permissions by encoding principals and permissions as bits of an
+    integer.  A set of principals is encoded as an integer with a bit set
+    for each principal, and each ACL entry is encoded as the bit for its
+    principal and a mask of the permissions it applies to, so that checking
+    an entry is just a matter of two bitwise ANDs::
+
+        bits = ACLBits(['view', 'edit', 'delete'])
+        principals = bits.encode_principals(effective_principals(request))
+        if bits.may(principals, 'edit', context):
+            ...
+
+    Principals are assigned bits as they are encountered in ACLs.  Other
+    principals, such as per user ids which never appear in an ACL, are left
+    out when encoding a set of principals, so the number of bits doesn't grow
+    with the number of users.  An encoded set of principals remembers the
+    principals it encodes and is re-encoded by `may` if ACLs encoded since
+    have introduced new principals.  Only the permissions passed to the
+    constructor may be checked.  Consecutive entries of an ACL with the same
+    access and permissions are merged into a single entry, with a bit set for
+    each principal.  Encoded ACLs are cached, keyed by identity, so an ACL
+    which is modified in place must be passed to `forget` or the cache
+    cleared with `clear`.  The number of cached ACLs is limited by
+    `max_cache_size`, set to `0` to disable caching altogether.
+    """
+    max_cache_size = 1000
+
+    def __init__(self, permissions):
+        self._permissions = dict([
+            (permission, 1 << i) for i, permission in enumerate(permissions)
+        ])
+        self._principals = {}
+        self._acls = {}
+        self._lock = threading.Lock()
+
+    def encode_principals(self, principals):
+        """
+        Returns an integer encoding the given set of principals.
+        """
+        principals = tuple(principals)
+        n_principals = len(self._principals)
+        return _EncodedPrincipals(
+            self._encode(principals), principals, n_principals)
+
+    def encode_acl(self, acl):
+        """
+        Returns the encoded form of an ACL: a tuple of `(allow, principals,
+        permissions)` entries, where `allow` is a boolean and `principals` and
+        `permissions` are integers.
+        """
+        encoded = self._acls.get(id(acl))
+        if encoded is not None:
+            return encoded[1]
+
+        entries = []
+        for access, principal, permissions in acl:
+            mask = 0
+            for permission, bit in self._permissions.items():
+                if permission in permissions:
+                    mask |= bit
+            if not mask:
+                continue # Never applies
+
+            allow = access == Allow
+            principal = self._principal_bit(principal)
+            if entries and entries[-1][0] == allow and entries[-1][2] == mask:
+                entries[-1] = (allow, entries[-1][1] | principal, mask)
+            else:
+                entries.append((allow, principal, mask))
+
+        # The ACL is kept in the cache so that its id can't be reused by
+        # another object while the encoded form is cached.
+        entries = tuple(entries)
+        if self.max_cache_size:
+            acls = self._acls
+            if len(acls) >= self.max_cache_size:
+                acls.clear()
+            acls[id(acl)] = (acl, entries)
+        return entries
+
+    def may(self, principals, permission, context):
+        """
+        Same as `happy.acl.may`, but `principals` is an integer returned by
+        `encode_principals`.
+        """
+        bit = self._permissions.get(permission)
+        if bit is None:
+            raise ValueError('Unknown permission: %s' % permission)
+
+        # Principals encoded before an ACL which introduced new principals
+        # was encoded may be missing bits, in which case they are re-encoded,
+        # in place, so they needn't be re-encoded again by the next check.
+        # Bits are then tested using a plain integer, which is faster.
+        known = self._principals
+        n_principals = len(known)
+        if getattr(principals, 'n_principals', n_principals) != n_principals:
+            principals.bits = self._encode(principals.principals)
+            principals.n_principals = n_principals
+        principal_bits = getattr(principals, 'bits', principals)
+
+        encoded_acls = self._acls
+        for acl in _acls(context):
+            if acl is None:
+                continue
+
+            encoded = encoded_acls.get(id(acl))
+            if encoded is None:
+                entries = self.encode_acl(acl)
+                if len(known) != n_principals:
+                    return self.may(principals, permission, context)
+            else:
+                entries = encoded[1]
+
+            for allow, ace_principals, permissions in entries:
+                if principal_bits & ace_principals and permissions & bit:
+                    return allow
+
+    def forget(self, acl):
+        """
+        Removes an ACL from the cache of encoded ACLs.
+        """
+        self._acls.pop(id(acl), None)
+
+    def clear(self):
+        """
+        Clears the cache of encoded ACLs.
+        """
+        self._acls.clear()
+
+    def _encode(self, principals):
+        known = self._principals
+        bits = 0
+        for principal in principals:
+            bits |= known.get(principal, 0)
+        return bits
+
+    def _principal_bit(self, principal):
+        bit = self._principals.get(principal)
+        if bit is None:
+            with self._lock:
+                bit = self._principals.get(principal)
+                if bit is None:
+                    bit = 1 << len(self._principals)
+                    self._principals[principal] = bit
+        return bit
+
+class _EncodedPrincipals(long):
+    """
+    A set of principals encoded by `ACLBits.encode_principals`, which also
+    remembers the principals and the number of principals known when it was
+    encoded.  If it is re-encoded, by `ACLBits.may`, `bits` is updated.
+    """
+    def __new__(cls, bits, principals, n_principals):
+        encoded = super(_EncodedPrincipals, cls).__new__(cls, bits)
+        encoded.bits = bits
+        encoded.principals = principals
+        encoded.n_principals = n_principals
+        return encoded
 
 def principals_with_permission(permission, context):
-    # Stolen direct from bfg, comments and all
     allowed = set()
-
-    for location in reversed(list(_lineage(context))):
+    for acl in reversed(_acls(context)):
         # NB: we're walking *up* the object graph from the root
-        acl = getattr(location, '__acl__', None)
-        if acl is None:
-            continue
+        if acl is not None:
+            allowed = _apply_acl(acl, permission, allowed)
+    return allowed
+
+def principals_with_permissions(permissions, contexts, memo=None):
+    """
+    Bulk version of `principals_with_permission`, for finding the principals
+    with each of several `permissions` for many `contexts`, such as when
+    indexing the contents of a site for security aware searching.  Returns a
+    list with a dict for each context, in order, mapping each permission to
+    a frozenset of the principals with that permission.
 
-        allowed_here = set()
-        denied_here = set()
-
-        for ace_action, ace_principal, ace_permissions in acl:
-            if ace_action == Allow and permission in ace_permissions:
-                if not ace_principal in denied_here:
-                    allowed_here.add(ace_principal)
-            if ace_action == Deny and permission in ace_permissions:
-                denied_here.add(ace_principal)
-                if ace_principal == Everyone:
-                    # clear the entire allowed set, as we've hit a
-                    # deny of Everyone ala (Deny, Everyone, ALL)
-                    allowed = set()
-                    break
-                elif ace_principal in allowed:
-                    allowed.remove(ace_principal)
-
-        allowed.update(allowed_here)
+    The principals computed for each model are remembered, keyed by
+    permission and object identity, so the ACLs of ancestors shared by many
+    contexts are only evaluated once.  A dict may be passed as `memo` to
+    share results between calls, for instance when indexing a large tree in
+    batches.  The memo should be discarded if any ACLs change.
+    """
+    if memo is None:
+        memo = {}
+    return [
+        dict([
+            (permission, _memoized_principals(permission, context, memo))
+            for permission in permissions
+        ])
+        for context in contexts
+    ]
+
+def _memoized_principals(permission, context, memo):
+    # Find the nearest ancestor with known principals
+    allowed = _no_principals
+    unknown = []
+    node = context
+    while node is not None:
+        known = memo.get((permission, id(node)))
+        if known is not None:
+            allowed = known[1]
+            break
+        unknown.append(node)
+        node = getattr(node, '__parent__', None)
+
+    # Compute principals from the top down.  Nodes are kept in the memo so
+    # that their ids can't be reused by other objects while the memo is in
+    # use.
+    for node in reversed(unknown):
+        acl = getattr(node, '__acl__', None)
+        if acl is not None:
+            allowed = frozenset(_apply_acl(acl, permission, allowed))
+        memo[(permission, id(node))] = (node, allowed)
 
     return allowed
 
+_no_principals = frozenset()
+
+def _apply_acl(acl, permission, allowed):
+    """
+    Given the set of principals, `allowed`, with `permission` on the parent
+    of a model, returns a new set of the principals with `permission` on the
+    model, which has the given `acl`.
+    """
+    # Stolen direct from bfg, comments and all
+    allowed = set(allowed)
+    allowed_here = set()
+    denied_here = set()
+
+    for ace_action, ace_principal, ace_permissions in acl:
+        if ace_action == Allow and permission in ace_permissions:
+            if not ace_principal in denied_here:
+                allowed_here.add(ace_principal)
+        if ace_action == Deny and permission in ace_permissions:
+            denied_here.add(ace_principal)
+            if ace_principal == Everyone:
+                # clear the entire allowed set, as we've hit a
+                # deny of Everyone ala (Deny, Everyone, ALL)
+                allowed = set()
+                break
+            elif ace_principal in allowed:
+                allowed.remove(ace_principal)
+
+    allowed.update(allowed_here)
+    return allowed
+
 def require_permission(permission):
     """
     Decorate a responder callable to require a particular permission.
@@ -92,9 +557,14 @@ def require_permission(permission):
         return wrapper
     return decorator
 
-def _lineage(context):
-    yield context
-    parent = getattr(context, '__parent__', None)
-    if parent is not None:
-        for ancestor in _lineage(parent):
-            yield ancestor
+def _acls(context):
+    """
+    Returns the `__acl__` of the context and each of its ancestors, or `None`
+    for those which don't have one, in order from the context to the root.
+    """
+    acls = [getattr(context, '__acl__', None)]
+    node = getattr(context, '__parent__', None)
+    while node is not None:
+        acls.append(getattr(node, '__acl__', None))
+        node = getattr(node, '__parent__', None)
+    return acls
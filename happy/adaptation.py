@@ -20,6 +20,9 @@ class AdaptationManager(object):
     def register(self, adapter, from_type, to_type):
         self.registry.register(adapter, from_type, to_type)
 
+    def freeze(self):
+        self.registry.freeze()
+
     def adapt(self, obj, to_type):
         adapter = self.registry.lookup(obj, to_type)
         if adapter is None:
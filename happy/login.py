@@ -76,6 +76,9 @@ import webob
 
 from webob.exc import HTTPFound
 
+from happy.request import application_url
+from happy.request import scoped_request
+
 class FormLoginMiddleware(object):
     """
     Handles login via a form and cookies.
@@ -111,7 +114,7 @@ class FormLoginMiddleware(object):
         if credential is not None:
             login = self.credential_broker.get_login(credential)
             if login is not None:
-                request = self.Request(request.environ.copy())
+                request = scoped_request(request, self.Request)
                 request.remote_user = self.principals_broker.get_userid(login)
                 request.authenticated_principals = \
                        self.principals_broker.get_principals(login)
@@ -128,7 +131,7 @@ class FormLoginMiddleware(object):
         return response
 
     def _login_url(self, request):
-        return request.application_url.rstrip('/') + self.login_path
+        return application_url(request) + self.login_path
 
     def _login(self, request):
         login = request.params.get('login', '')
@@ -48,30 +48,71 @@ default_view.  Specificity is applied (or not applied) by individual axes.
 XXX Todo Explain left to right ordering when searching axes and interaction
 with specificity.
 
-An axis object implements a basic interface comprised of one method::
-
-interface Axis: def matches(obj, keys): ''' For a given object, `obj`, return
-the subset of keys which match this object in this axis, in order from most to
-least specific. ''' The `SimpleAxis` class included in this module implements
-the most basic axis possible--one that effectively acts like a dictionary,
-where the object is the key to the axis. It also provides a means of creating
-axis classes by means of what might be a more intuitive override. The
-`get_keys` simply returns keys used for lookup in the axis for a given
-object and is a convenient override point.
+An axis object implements a basic interface comprised of one required method
+and one optional method::
+
+    interface Axis:
+        def matches(obj, keys):
+            '''
+            For a given object, `obj`, return the subset of keys which match
+            this object in this axis, in order from most to least specific.
+            '''
+
+        def cache_key(obj):
+            '''
+            Optional.  Return a cheap, hashable key which fully determines
+            the result of `matches` for `obj`, or `None` if the result for
+            this particular object should not be cached.
+            '''
+
+The `SimpleAxis` class included in this module implements the most basic axis
+possible--one that effectively acts like a dictionary, where the object is the
+key to the axis. It also provides a means of creating axis classes by means of
+what might be a more intuitive override. The `get_keys` simply returns keys
+used for lookup in the axis for a given object and is a convenient override
+point.
+
+The registry uses `cache_key`, when an axis provides it, to memoize both the
+ordered matches for each axis and whole lookups.  Lookups through an axis
+which doesn't implement `cache_key` are always performed without caching.
 """
 # XXX Everything written in English here currently blows.  Find a way to
 #     explain this better.
 
+import itertools
+
 class Registry(object):
     """
     Implements registry.  See module level documentation.
+
+    Results of lookups are memoized, keyed on the cache key provided by each
+    axis for the objects being looked up (the type for `TypeAxis`, the object
+    itself for `SimpleAxis`).  Lookups involving an axis which doesn't
+    provide a `cache_key` method are not cached.  The cache is cleared
+    whenever a registration is made.  The number of cached lookups is
+    limited by `max_cache_size`, set to `0` to disable caching altogether.
+    The `cache_hits` and `cache_misses` counters can be used to check the
+    effectiveness of the cache.
+
+    Once all registrations have been made, typically at application startup,
+    the registry may be frozen by calling `freeze`.  A frozen registry
+    compiles its registrations into a flat dispatch table, so lookups no
+    longer need to walk the registration tree.  Attempting to register with
+    a frozen registry raises `ValueError`.
     """
+    max_cache_size = 1000
+
     def __init__(self, *axes):
         self._tree = _TreeNode()
         self._axes = [axis for name, axis in axes]
         self._axes_dict = dict([
             (name, (i, axis)) for i, (name, axis) in enumerate(axes)
         ])
+        self._cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._dispatch = None
+        self._axis_keys = None
 
     def register(self, target, *arg_keys, **kw_keys):
         self._register(target, self._align_with_axes(arg_keys, kw_keys), False)
@@ -80,8 +121,14 @@ class Registry(object):
         self._register(target, self._align_with_axes(arg_keys, kw_keys), True)
 
     def _register(self, target, keys, override):
+        if self._dispatch is not None:
+            raise ValueError(
+                "Registry is frozen.  No further registrations may be made."
+            )
+
         tree_node = self._tree
         for key in keys:
+            tree_node.matches.clear()
             if not tree_node.has_key(key):
                 tree_node[key] = _TreeNode()
             tree_node = tree_node[key]
@@ -93,6 +140,7 @@ class Registry(object):
             )
 
         tree_node.target = target
+        self._cache.clear()
 
     def get_registration(self, *arg_keys, **kw_keys):
         tree_node = self._tree
@@ -103,12 +151,147 @@ class Registry(object):
 
         return tree_node.target
 
+    def freeze(self):
+        """
+        Compile registrations into a flat dispatch table, mapping the full
+        tuple of keys for each registration to its target, along with the
+        set of keys in use for each axis.  After freezing, lookups are
+        performed by probing the dispatch table with each combination of
+        matching keys, from most to least specific, and no further
+        registrations may be made.
+        """
+        dispatch = {}
+        axis_keys = [{} for axis in self._axes]
+        nodes = [(self._tree, ())]
+        while nodes:
+            tree_node, keys = nodes.pop()
+            if tree_node.target is not None:
+                dispatch[keys] = tree_node.target
+            for key, next_node in tree_node.items():
+                if key is not None:
+                    axis_keys[len(keys)][key] = None
+                nodes.append((next_node, keys + (key,)))
+
+        self._axis_keys = axis_keys
+        self._axis_matches = [{} for axis in self._axes]
+        self._dispatch = dispatch
+        self._cache.clear()
+
     def lookup(self, *arg_objs, **kw_objs):
         objs = self._align_with_axes(arg_objs, kw_objs)
-        axes = self._axes
-        return self._lookup(self._tree, objs, axes)
+        axis_keys = self._axis_cache_keys(objs)
+        cache_key = self._cache_key(objs, axis_keys)
+        if cache_key is None:
+            return self._find(objs, axis_keys)
+
+        cache = self._cache
+        try:
+            target = cache.get(cache_key, _marker)
+        except TypeError: # Unhashable
+            return self._find(objs, axis_keys)
+        if target is not _marker:
+            self.cache_hits += 1
+            return target
+
+        self.cache_misses += 1
+        target = self._find(objs, axis_keys)
+        if len(cache) >= self.max_cache_size:
+            cache.clear()
+        cache[cache_key] = target
+        return target
+
+    def _axis_cache_keys(self, objs):
+        """
+        Get the cache key of each object on its axis, or `None` where the
+        axis doesn't provide a cache key for the object.  Cache keys are
+        computed once per lookup, since computing them might be expensive,
+        and are used both to memoize the whole lookup and to memoize matches
+        on each axis.
+        """
+        if not self.max_cache_size:
+            return [None] * len(objs)
+
+        axis_keys = []
+        for obj, axis in zip(objs, self._axes):
+            cache_key = getattr(axis, 'cache_key', None)
+            if obj is None or cache_key is None:
+                axis_keys.append(None)
+            else:
+                axis_keys.append(cache_key(obj))
+        return axis_keys
+
+    def _cache_key(self, objs, axis_keys):
+        """
+        Build the key used to memoize a lookup from the cache keys of each
+        axis, or return `None` if the lookup can't be cached.
+        """
+        if not self.max_cache_size:
+            return None
+
+        for obj, axis_key in zip(objs, axis_keys):
+            if obj is not None and axis_key is None:
+                return None
+
+        return tuple(axis_keys)
+
+    def _find(self, objs, axis_keys):
+        if self._dispatch is None:
+            return self._lookup(self._tree, objs, self._axes, axis_keys)
+        return self._lookup_frozen(objs, axis_keys)
+
+    def _lookup_frozen(self, objs, axis_keys):
+        """
+        Probe the dispatch table of a frozen registry with combinations of
+        matching keys.  The product of each axis's matches, from left to
+        right, most specific to least specific, yields the same search order
+        as a walk of the registration tree.  Matches which aren't memoized
+        are generated lazily, so that, as for a walk of the tree, no more of
+        them are evaluated than are needed to find a target.
+        """
+        candidates = []
+        lazy = False
+        for obj, axis, keys, memo, cache_key in zip(
+            objs, self._axes, self._axis_keys, self._axis_matches, axis_keys):
+            if obj is None:
+                candidates.append((None,))
+                continue
+
+            matches = self._matches(axis, obj, keys, memo, cache_key)
+            if type(matches) is not tuple:
+                matches = _LazyMatches(matches)
+                lazy = True
+            elif not matches:
+                return None
+            candidates.append(matches)
+
+        if lazy:
+            return self._probe(candidates, ())
+
+        dispatch = self._dispatch
+        for keys in itertools.product(*candidates):
+            target = dispatch.get(keys)
+            if target is not None:
+                return target
 
-    def _lookup(self, tree_node, objs, axes):
+        return None
+
+    def _probe(self, candidates, keys):
+        """
+        Depth first search of the product of `candidates`, probing the
+        dispatch table with each full combination of keys.
+        """
+        i = len(keys)
+        if i == len(candidates):
+            return self._dispatch.get(keys)
+
+        for key in candidates[i]:
+            target = self._probe(candidates, keys + (key,))
+            if target is not None:
+                return target
+
+        return None
+
+    def _lookup(self, tree_node, objs, axes, axis_keys):
         """
         Recursively traverse registration tree, from left to right, most
         specific to least specific, returning the first target found on a
@@ -123,32 +306,56 @@ class Registry(object):
         if obj is None:
             next_node = tree_node.get(None, None)
             if next_node is not None:
-                return self._lookup(next_node, objs[1:], axes[1:])
+                return self._lookup(
+                    next_node, objs[1:], axes[1:], axis_keys[1:])
             return None
 
         # Get matches on this axis and iterate from most to least specific
         axis = axes[0]
-        for match_key in axis.matches(obj, tree_node.keys()):
-            target = self._lookup(tree_node[match_key], objs[1:], axes[1:])
+        matches = self._matches(
+            axis, obj, tree_node, tree_node.matches, axis_keys[0])
+        for match_key in matches:
+            target = self._lookup(
+                tree_node[match_key], objs[1:], axes[1:], axis_keys[1:])
             if target is not None:
                 return target
 
         return None
 
+    def _matches(self, axis, obj, keys, memo, cache_key):
+        """
+        Get matches for `obj` on `axis`, memoized in `memo` by the axis's
+        cache key for the object, if it has one.
+        """
+        if cache_key is not None:
+            try:
+                matches = memo.get(cache_key)
+            except TypeError: # Unhashable
+                return axis.matches(obj, keys)
+            if matches is None:
+                matches = tuple(axis.matches(obj, keys))
+                if len(memo) >= self.max_cache_size:
+                    memo.clear()
+                memo[cache_key] = matches
+            return matches
+
+        return axis.matches(obj, keys)
+
     def _align_with_axes(self, args, kw):
         """
         Create a list matching up all args and kwargs with their corresponding
         axes, in order, using 'None' as a placeholder for skipped axes.
         """
         axes_dict = self._axes_dict
-        aligned = [None for i in xrange(len(axes_dict))]
+        n_axes = len(axes_dict)
 
         args_len = len(args)
-        if args_len + len(kw) >  len(aligned):
+        if args_len + len(kw) > n_axes:
             raise ValueError('Cannot have more arguments than axes.')
 
-        for i, arg in enumerate(args):
-            aligned[i] = arg
+        aligned = list(args)
+        if kw:
+            aligned.extend([None] * (n_axes - args_len))
 
         for k, v in kw.items():
             i_axis = axes_dict.get(k, None)
@@ -171,6 +378,32 @@ class Registry(object):
 class _TreeNode(dict):
     target = None
 
+    def __init__(self):
+        self.matches = {} # Memoized matches by axis cache key
+
+class _LazyMatches(object):
+    """
+    Wraps the matches generated by an axis, so that they may be iterated more
+    than once, while only generating as many as are needed.
+    """
+    def __init__(self, matches):
+        self._matches = iter(matches)
+        self._generated = []
+
+    def __iter__(self):
+        generated = self._generated
+        i = 0
+        while True:
+            if i == len(generated):
+                try:
+                    generated.append(self._matches.next())
+                except StopIteration:
+                    return
+            yield generated[i]
+            i += 1
+
+_marker = object()
+
 class SimpleAxis(object):
     """
     A simple axis where the key into the axis is the same as the object to be
@@ -184,7 +417,11 @@ class SimpleAxis(object):
     """
     def matches(self, obj, keys):
         for key in self.get_keys(obj):
-            if key in keys:
+            try:
+                found = key in keys
+            except TypeError: # Unhashable, so can't have been registered
+                continue
+            if found:
                 yield key
 
     def get_keys(self, obj):
@@ -194,6 +431,17 @@ class SimpleAxis(object):
         """
         return [obj,]
 
+    def cache_key(self, obj):
+        """
+        Return a hashable key which determines the result of `matches` for
+        the given object.  Used by the registry to memoize lookups.
+        Subclasses which override `matches` or `get_keys` are not cached,
+        unless they override this as well.
+        """
+        if _overrides(self, SimpleAxis):
+            return None
+        return obj
+
 class TypeAxis(SimpleAxis):
     """
     An axis which matches the class and super classes of an object in method
@@ -201,3 +449,26 @@ class TypeAxis(SimpleAxis):
     """
     def get_keys(self, obj):
         return type(obj).mro()
+
+    def cache_key(self, obj):
+        if _overrides(self, TypeAxis):
+            return None
+        return type(obj)
+
+def _overrides(axis, cls):
+    """
+    Whether the class of `axis` overrides `matches` or `get_keys` of `cls`,
+    in which case the cache key provided by `cls` may not determine the
+    matches for an object.  Checked once per axis class.
+    """
+    key = (type(axis), cls)
+    overrides = _overridden.get(key)
+    if overrides is None:
+        overrides = _overridden[key] = False
+        for name in ('matches', 'get_keys'):
+            method = getattr(type(axis), name).im_func
+            if method is not getattr(cls, name).im_func:
+                overrides = _overridden[key] = True
+    return overrides
+
+_overridden = {}
@@ -0,0 +1,65 @@
+"""
+Tools for working with request objects.
+
+Dispatchers and middleware commonly decorate a request with attributes, such
+as `context` or `match_dict`, before passing it along to a responder.  Those
+decorations shouldn't leak back out to the caller, which might go on to pass
+the same request to some other responder.  A scoped request isolates
+decorations::
+
+    from happy.request import scoped_request
+
+    def dispatcher(request):
+        request = scoped_request(request)
+        request.context = find_context(request)
+        return view(request)
+
+A scoped request is a new request for a copy of the original request's
+environ.  WebOb stores ad hoc attributes in the environ, in
+`webob.adhoc_attrs`, which a plain copy of the environ would share with the
+original request, so that dict is copied as well.  Ad hoc attributes of the
+original request remain readable from the scoped request, while attributes
+set on the scoped request are only visible to it and to any request later
+created from its environ, for instance by a WSGI application called with
+`get_response`.
+
+Code which generates many URLs for a single request, such as a listing page,
+can use `application_url` to avoid reconstructing the application URL from
+the environ for each URL generated.
+"""
+import webob
+
+def application_url(request):
+    """
+    Returns the request's `application_url`, without any trailing slash, so
+    that it may be used as a prefix for absolute paths.  The URL is cached in
+    the request's environ, along with the parts of the environ it is derived
+    from, so that it is recomputed if any of them change, for instance if
+    `script_name` is rewritten by a dispatcher.
+    """
+    environ = request.environ
+    key = (
+        environ.get('SCRIPT_NAME'),
+        environ.get('HTTP_HOST'),
+        environ.get('SERVER_NAME'),
+        environ.get('SERVER_PORT'),
+        environ.get('wsgi.url_scheme'),
+    )
+    cached = environ.get('happy.application_url')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    url = request.application_url.rstrip('/')
+    environ['happy.application_url'] = (key, url)
+    return url
+
+def scoped_request(request, Request=webob.Request):
+    """
+    Returns a new instance of `Request` for a copy of the environ of
+    `request`, including a copy of its ad hoc attributes.
+    """
+    environ = request.environ.copy()
+    attrs = environ.get('webob.adhoc_attrs')
+    if attrs is not None:
+        environ['webob.adhoc_attrs'] = attrs.copy()
+    return Request(environ)
@@ -3,9 +3,15 @@ This package provides a fairly simplified implementation of so called "routes"
 based dispatch. This is based loosely on the style of dispatch used by Pylons,
 Ruby on Rails, BFG and others.
 """
-import inspect
+import re
+import threading
 import webob
 
+from happy.request import application_url
+from happy.request import scoped_request
+from happy.view import REQUEST_ONLY
+from happy.view import calling_convention
+
 class RoutesDispatcher(object):
     """
     The ``RoutesDispatcher`` class provides URL based dispatch based on
@@ -52,6 +58,10 @@ class RoutesDispatcher(object):
       def controller(request):
           animal = request.match_dict['animal']
 
+    The calling convention of a controller is determined once, when it is
+    registered, and is available as the ``convention`` attribute of its route
+    (see ``happy.view.calling_convention``).
+
     An asterisk, `*`, may optionally appear at the end of any route and matches
     zero or more arbitrary path segments::
 
@@ -62,8 +72,23 @@ class RoutesDispatcher(object):
     `animal`.  Any segments following the first two are considered the
     `subpath` and will be assigned to the ``subpath`` attribute of request.
 
+    A variable may optionally be constrained to segments matching a regular
+    expression, given in angle brackets following the variable name.  The
+    special constraint, `int`, matches digits only and converts the matched
+    segment to an integer::
+
+      dispatcher.register(controller, 'post', '/posts/:id<int>')
+      dispatcher.register(controller, 'tag', '/tags/:slug<[a-z-]+>')
+
+    Constraints are compiled once, at registration time.  A constrained
+    variable is tried before an unconstrained variable at the same position,
+    in the order they were registered.
+
     In some cases more than one route may match a particular url.  In these
-    cases, the more specific registration wins.  Consider these two
+    cases, the more specific registration wins, where literal segments are
+    more specific than variables, which are more specific than wildcards,
+    from left to right.  If a more specific branch fails to match the rest of
+    the path, less specific alternatives are tried.  Consider these two
     registrations::
 
       dispatcher.register(controller1, 'animal', '/foo/:animal/*')
@@ -73,15 +98,15 @@ class RoutesDispatcher(object):
     while `/foo/bar/two` will be dispatched to controller2.
 
     When calling the target controller for a route, the dispatcher will create
-    new copy of the request object and then, optionally, rewrite the
-    `script_name` and `path_info` attributes such that the target controller
-    is called as though it were a stand alone application (which it very well
-    could be). The default behavior is to not rewrite `script_name` and
-    `path_info`. To enable rewriting, pass a value of `True` to the
-    `rewrite_paths` parameter of the class constructor. When rewriting is
-    enabled, the portion of the url path consumed by the route will be
-    appended to the end of `script_name` and the `subpath` will become the new
-    `path_info`. The following code illustrates::
+    a scoped copy of the request object (see ``happy.request``) and then,
+    optionally, rewrite the `script_name` and `path_info` attributes such that
+    the target controller is called as though it were a stand alone
+    application (which it very well could be). The default behavior is to not
+    rewrite `script_name` and `path_info`. To enable rewriting, pass a value
+    of `True` to the `rewrite_paths` parameter of the class constructor. When
+    rewriting is enabled, the portion of the url path consumed by the route
+    will be appended to the end of `script_name` and the `subpath` will
+    become the new `path_info`. The following code illustrates::
 
       dispatcher.register(controller, 'animals', '/foo/:animal/*')
 
@@ -97,13 +122,21 @@ class RoutesDispatcher(object):
       assert request.path_info == '/foo/cat/tiger/lily'
 
       dispatcher(request)
+
+    Matches may optionally be cached, by passing the maximum number of paths
+    to cache as the `cache_size` parameter of the class constructor.  The
+    least recently used paths are evicted from the cache once it is full and
+    the cache is cleared whenever a route is registered.  The `cache_hits` and
+    `cache_misses` counters can be used to check the effectiveness of the
+    cache.
     """
     Request = webob.Request # Request factory is overridable
 
-    def __init__(self, rewrite_paths=False):
+    def __init__(self, rewrite_paths=False, cache_size=0):
         self._tree = _TreeNode()
         self._routes_by_name = {}
         self.rewrite_paths = rewrite_paths
+        self._cache = _LRUCache(cache_size)
 
     def register(self, target, name, path):
         return self._register(target, name, path, False)
@@ -112,16 +145,15 @@ class RoutesDispatcher(object):
         return self._register(target, name, path, True)
 
     def _register(self, target, name, path, override):
-        route = Route(self._wrap_callable(target), path)
+        route = Route(target, path)
         tree_node = self._tree
         for element in route._route:
-            if element.variable:
-                key = ':'
-            else:
-                key = element.name
-
+            key = element.key
             if not tree_node.has_key(key):
-                tree_node[key] = _TreeNode()
+                tree_node[key] = next_node = _TreeNode()
+                if element.pattern is not None:
+                    tree_node.patterns = tree_node.patterns + (
+                        (element, next_node),)
 
             tree_node = tree_node[key]
 
@@ -133,43 +165,133 @@ class RoutesDispatcher(object):
 
         tree_node.route = route
         self._routes_by_name[name] = route
+        self._cache.clear()
         return route
 
     def __getitem__(self, name):
         return self._routes_by_name[name]
 
+    @property
+    def cache_hits(self):
+        return self._cache.hits
+
+    @property
+    def cache_misses(self):
+        return self._cache.misses
+
     def match(self, path):
+        cache = self._cache
+        if not cache.size:
+            return self._match_path(path)
+
+        match = cache.get(path, _marker)
+        if match is _marker:
+            match = self._match_path(path)
+            cached = None
+            if match is not None:
+                route, consumed, subpath, args = match
+                cached = route, tuple(consumed), tuple(subpath), \
+                         tuple(args.items())
+            cache.put(path, cached)
+            return match
+
+        if match is None:
+            return None
+
+        # Hand out fresh copies, so callers are free to mutate them.
+        route, consumed, subpath, args = match
+        return route, list(consumed), list(subpath), dict(args)
+
+    def _match_path(self, path):
         elements = filter(None, path.split('/'))
-        match = self._match(self._tree, [], elements)
+        match = self._match(elements)
         if match is None:
             return None
 
-        route, consumed, subpath = match
+        route, i = match
         args = {}
         for index in route._variable_indices:
-            name = route._route[index].name
-            args[name] = elements[index]
+            element = route._route[index]
+            args[element.name] = element.convert(elements[index])
+
+        return route, elements[:i], elements[i:], args
+
+    def _match(self, elements):
+        """
+        Returns the matched route and the number of path elements consumed,
+        or `None` if there is no match.  At each level of the tree, a literal
+        match is tried first, followed by constrained variables, an
+        unconstrained variable and finally a wildcard.  The most specific
+        alternative is greedily followed and, in the common case, this finds
+        the match.  Only if that leads to a dead end is `_backtrack` used to
+        try less specific alternatives.
+        """
+        n_elements = len(elements)
+        tree_node = self._tree
+        i = 0
+        while i < n_elements:
+            element = elements[i]
+            next_node = tree_node.get(element, None)
+            if next_node is None:
+                for variable, variable_node in tree_node.patterns:
+                    if variable.match(element):
+                        next_node = variable_node
+                        break
+                else:
+                    next_node = tree_node.get(':', None)
+            if next_node is None:
+                if '*' in tree_node:
+                    return tree_node['*'].route, i
+                break
+            tree_node = next_node
+            i += 1
+        else:
+            route = tree_node.route
+            if route is None and '*' in tree_node:
+                route = tree_node['*'].route
+            if route is not None:
+                return route, i
+
+        if i:
+            # Dead end after descending at least one level
+            return self._backtrack(elements)
+        return None
+
+    def _backtrack(self, elements):
+        """
+        Walks the tree depth first, in the same order of precedence as
+        `_match`, but backtracking to the next alternative when a branch turns
+        out to be a dead end.  Since every tree node is at a fixed depth, each
+        node is visited at most once.
+        """
+        n_elements = len(elements)
+        tree_node = self._tree
+        i = 0
+        choice = 0
+        backtrack = []
+        while True:
+            if i == n_elements:
+                route = tree_node.route
+                if route is None and '*' in tree_node:
+                    route = tree_node['*'].route
+                if route is not None:
+                    return route, i
 
-        return route, consumed, subpath, args
+            else:
+                next_node, choice = _next_node(tree_node, elements[i], choice)
+                if next_node is not None:
+                    backtrack.append((tree_node, i, choice + 1))
+                    tree_node = next_node
+                    i += 1
+                    choice = 0
+                    continue
 
-    def _match(self, tree_node, consumed, subpath):
-        if not subpath:
-            if tree_node.route is not None:
-                return tree_node.route, consumed, subpath
-            if '*' in tree_node:
-                return tree_node['*'].route, consumed, subpath
-            return None
+                if '*' in tree_node:
+                    return tree_node['*'].route, i
 
-        next_node = None
-        element = subpath[0]
-        next_node = tree_node.get(element, None)
-        if next_node is None:
-            next_node = tree_node.get(':', None)
-        if next_node is None:
-            if '*' in tree_node:
-                return tree_node['*'].route, consumed, subpath
-            return None
-        return self._match(next_node, consumed + [element], subpath[1:])
+            if not backtrack:
+                return None
+            tree_node, i, choice = backtrack.pop()
 
     def __call__(self, request, path=None):
         # Allow path to be called in, in case we don't want to start matching
@@ -185,10 +307,10 @@ class RoutesDispatcher(object):
 
         route, consumed, subpath, args = match
 
-        # Make new copy of request, so our decorations don't leak outside of
-        # this dispatcher.
+        # Scope request, so our decorations don't leak outside of this
+        # dispatcher.
         original_request = request
-        request = self.Request(request.environ.copy())
+        request = scoped_request(request, self.Request)
 
         # Optionally, rewrite script_name and path_name
         if self.rewrite_paths:
@@ -210,21 +332,38 @@ class RoutesDispatcher(object):
         request.request = original_request
 
         # Call target
+        if route.convention is REQUEST_ONLY:
+            return route.target(request)
         return route.target(request, **args)
 
-    def _wrap_callable(self, controller):
-        def request_only_signature(request, **args):
-            return controller(request)
+def _next_node(tree_node, element, choice):
+    """
+    Finds the child of `tree_node` matching `element`, starting with the
+    given alternative, where alternative 0 is a literal match, alternatives 1
+    through N are the constrained variables and N + 1 is the unconstrained
+    variable.  Returns the child and the alternative chosen, or
+    `(None, None)` if there are no more alternatives.
+    """
+    if choice == 0:
+        next_node = tree_node.get(element, None)
+        if next_node is not None:
+            return next_node, 0
+        choice = 1
 
-        if inspect.isfunction(controller):
-            func = controller
-        else:
-            func = controller.__call__
+    patterns = tree_node.patterns
+    n_patterns = len(patterns)
+    while choice <= n_patterns:
+        variable, next_node = patterns[choice - 1]
+        if variable.match(element):
+            return next_node, choice
+        choice += 1
 
-        args, varargs, keywords, defaults = inspect.getargspec(func)
-        if args == ['request'] and not(varargs or keywords or defaults):
-            return request_only_signature
-        return func
+    if choice == n_patterns + 1:
+        next_node = tree_node.get(':', None)
+        if next_node is not None:
+            return next_node, choice
+
+    return None, None
 
 class Route(object):
     def __init__(self, target, path):
@@ -242,42 +381,155 @@ class Route(object):
             wildcard = path_element.wildcard
 
         self.target = target
+        self.convention = calling_convention(target)
         self.path = path
         self._route = route
         self._variable_indices = variable_indices
+        self._compile_template()
 
     def url(self, request, **match_dict):
-        subpath = match_dict.pop('subpath', None)
-        path_info = []
+        return application_url(request) + self._path_info(match_dict)
+
+    def urls(self, request, match_dicts):
+        """
+        Generates a URL for each of the match dicts in the iterable,
+        `match_dicts`, returning a list of URLs.  Equivalent to calling `url`
+        for each match dict, but faster when generating many URLs.
+        """
+        prefix = application_url(request)
+        path_info = self._path_info
+        return [prefix + path_info(match_dict) for match_dict in match_dicts]
+
+    def _compile_template(self):
+        """
+        Precompile the route into a URL template: the static parts of the
+        path, pre-joined, which fall between variables.
+        """
+        statics = []
+        names = []
+        static = ''
         for element in self._route:
             if element.variable:
-                path_info.append(match_dict[element.name])
-            elif element.wildcard:
-                if subpath is not None:
-                    path_info += subpath
-            else:
-                path_info.append(element.name)
-
-        path_info = '/' + '/'.join(path_info)
-        if self.path.endswith('/') or (
-            self.path.endswith('*') and not subpath):
+                statics.append(static + '/')
+                names.append(element.name)
+                static = ''
+            elif not element.wildcard:
+                static += '/' + element.name
+        statics.append(static)
+
+        self._template = tuple(zip(names, statics[1:]))
+        self._template_head = statics[0]
+        self._wildcard = bool(self._route) and self._route[-1].wildcard
+        self._trailing_slash = self.path.endswith('/')
+
+    def _path_info(self, match_dict):
+        path_info = self._template_head
+        for name, static in self._template:
+            value = match_dict[name]
+            if not isinstance(value, basestring):
+                value = str(value)
+            path_info += value + static
+
+        subpath = None
+        if self._wildcard:
+            subpath = match_dict.get('subpath')
+            if subpath:
+                path_info += '/' + '/'.join(subpath)
+
+        if not path_info:
+            path_info = '/'
+        if self._trailing_slash or (self._wildcard and not subpath):
             path_info += '/'
-
-        return request.application_url.rstrip('/') + path_info
+        return path_info
 
 class _PathElement(object):
     wildcard = False
     variable = False
+    pattern = None
 
     def __init__(self, element):
+        self.key = element
         if element.startswith(':'):
             self.variable = True
-            self.name = element[1:]
+            self.key = ':'
+            name = element[1:]
+            if name.endswith('>') and '<' in name:
+                name, constraint = name[:-1].split('<', 1)
+                # Not a string, so that a literal path segment can never
+                # match the key of a constrained variable.
+                self.key = (':', constraint)
+                if constraint == 'int':
+                    self.convert = int
+                    constraint = r'\d+'
+                self.pattern = re.compile(r'(?:%s)\Z' % constraint)
+            self.name = name
         elif element == '*':
             self.wildcard = True
             self.name = '*'
         else:
             self.name = element
 
+    def match(self, segment):
+        return self.pattern.match(segment) is not None
+
+    def convert(self, segment):
+        return segment
+
+class _LRUCache(object):
+    """
+    A thread safe, least recently used cache.  Entries are kept in a circular
+    doubly linked list, in order of use, with the root of the list pointing
+    at the most and least recently used entries.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._root = root = [] # [prev, next, key, value]
+            root[:] = [root, root, None, None]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            # Move to front
+            prev, next, key, value = entry
+            prev[1] = next
+            next[0] = prev
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = entry
+            entry[0] = last
+            entry[1] = root
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            entries = self._entries
+            if key in entries:
+                return
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = entries[key] = [last, root, key, value]
+
+            if len(entries) > self.size:
+                oldest = root[1]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+                del entries[oldest[2]]
+
+_marker = object()
+
 class _TreeNode(dict):
     route = None
+    patterns = () # (path element, tree node) for constrained variables
@@ -12,6 +12,12 @@ if hasattr(mimetypes, 'init'):
 class FileResponse(webob.Response):
     """
     Serves a file from the filesystem.
+
+    If the WSGI server provides a `wsgi.file_wrapper`, the file is served
+    using it, which allows the server to use a platform specific mechanism,
+    such as `sendfile`, to transmit the file without reading it through
+    Python.  Otherwise the file is read and served in chunks of
+    `buffer_size` bytes.
     """
     def __init__(self, path, request=None,
                  buffer_size=DEFAULT_BUFFER_SIZE,
@@ -46,7 +52,12 @@ class FileResponse(webob.Response):
             content_length = end - start
 
         self.date = datetime.utcnow()
-        self.app_iter = _file_iter(path, buffer_size, request_range)
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            self.app_iter = _wrap_file(
+                file_wrapper, path, buffer_size, request_range)
+        else:
+            self.app_iter = _file_iter(path, buffer_size, request_range)
         self.content_type = mimetypes.guess_type(path, strict=False)[0]
         self.content_length = content_length
         if expires_timedelta is not None:
@@ -112,6 +123,59 @@ class DirectoryApplication(object):
         that kind of thing.
         """
 
+def _wrap_file(file_wrapper, path, buffer_size, content_range=None):
+    return file_wrapper(_LazyFile(path, content_range), buffer_size)
+
+class _LazyFile(object):
+    """
+    A file-like object for the file at `path`, which is only opened when it
+    is first used, so that a response which is discarded without being
+    served, like one whose app_iter is a generator, doesn't hold an open
+    file.  If a byte range is given, the file is positioned at the start of
+    the range when opened and reading stops at the end of the range.  The
+    underlying file's `fileno` is exposed so that servers may still use
+    `sendfile`.  PEP 3333 requires servers not to transmit more bytes than
+    the response's Content-Length, which is set to the length of the range.
+    """
+    _file = None
+
+    def __init__(self, path, content_range=None):
+        self.path = path
+        if content_range is None:
+            self._start = 0
+            self.bytes_left = None
+        else:
+            start, end = content_range
+            self._start = start
+            self.bytes_left = end - start
+
+    def _open(self):
+        f = self._file
+        if f is None:
+            f = self._file = open(self.path, 'rb')
+            if self._start:
+                f.seek(self._start)
+        return f
+
+    def read(self, size=-1):
+        f = self._open()
+        bytes_left = self.bytes_left
+        if bytes_left is None:
+            return f.read(size)
+
+        if size < 0 or size > bytes_left:
+            size = bytes_left
+        b = f.read(size)
+        self.bytes_left -= len(b)
+        return b
+
+    def fileno(self):
+        return self._open().fileno()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
 def _file_iter(path, buffer_size, content_range=None):
     f = open(path, 'rb')
     if content_range is not None:
@@ -42,6 +42,40 @@ class TestMay(unittest.TestCase):
         self.failUnless(may(['chris', 'group.Admin'], 'edit', context))
         self.failIf(may(['chris', 'Everyone'], 'edit', context))
 
+    def test_compiled_acl(self):
+        from happy.acl import may
+        from happy.acl import compile_acl
+        from happy.acl import Allow
+        from happy.acl import ALL_PERMISSIONS
+        from happy.acl import Deny
+        root = DummyModel()
+        context = root['foo'] = DummyModel()
+        acl = [
+            (Allow, 'Everyone', 'view'),
+            (Allow, 'group.Admin', 'view,edit'),
+            (Deny, 'Everyone', ALL_PERMISSIONS),
+        ]
+        root.__acl__ = compile_acl(acl)
+        self.assertEqual(list(root.__acl__), acl)
+        context.__acl__ = compile_acl([(Deny, 'paul', ['view'])])
+        for i in range(2):
+            self.failUnless(may(['chris', 'Everyone'], 'view', context))
+            self.failUnless(may(['chris', 'group.Admin'], 'edit', context))
+            self.failIf(may(['chris', 'Everyone'], 'edit', context))
+            self.failIf(may(['paul', 'Everyone'], 'view', context))
+        self.assertEqual(root.__acl__.entries('edit'), (
+            (Allow, 'group.Admin'), (Deny, 'Everyone')))
+
+    def test_deep_lineage(self):
+        from happy.acl import may
+        from happy.acl import Allow
+        root = context = DummyModel()
+        root.__acl__ = [(Allow, 'chris', ['view'])]
+        for i in xrange(5000):
+            child = context['child'] = DummyModel()
+            context = child
+        self.failUnless(may(['chris'], 'view', context))
+
 class TestRequirePermission(unittest.TestCase):
     def test_basic_deny_allow(self):
         from happy.acl import require_permission
@@ -74,6 +108,223 @@ class TestRequirePermission(unittest.TestCase):
         request.context = DummyModel()
         self.assertEqual(app(request).status_int, 401)
 
+class TestHasPermission(unittest.TestCase):
+    def test_cached(self):
+        from happy.acl import has_permission
+        from happy.acl import forget_permissions
+        from happy.acl import Allow
+        from happy.acl import Authenticated
+        import webob
+        request = webob.Request.blank('/')
+        context = DummyModel()
+        context.__acl__ = [(Allow, Authenticated, ['view'])]
+        self.failIf(has_permission(request, 'view', context))
+
+        request.remote_user = 'chris'
+        self.failUnless(has_permission(request, 'view', context))
+        self.assertEqual(request.environ['happy.acl'].principals,
+                         frozenset(['system.Everyone', Authenticated]))
+
+        context.__acl__.pop()
+        self.failUnless(has_permission(request, 'view', context))
+        forget_permissions(request)
+        self.failIf(has_permission(request, 'view', context))
+
+        context.__acl__ = [(Allow, Authenticated, ['view'])]
+        self.failUnless(has_permission(request, 'view', context))
+
+    def test_authenticated_principals_changed(self):
+        from happy.acl import has_permission
+        from happy.acl import Allow
+        import webob
+        request = webob.Request.blank('/')
+        request.remote_user = 'chris'
+        request.authenticated_principals = ['chris']
+        request.context = DummyModel()
+        request.context.__acl__ = [(Allow, 'group.Admin', ['edit'])]
+        self.failIf(has_permission(request, 'edit'))
+        request.authenticated_principals = ['chris', 'group.Admin']
+        self.failUnless(has_permission(request, 'edit'))
+
+class TestFilterPermitted(unittest.TestCase):
+    def test_filter_permitted(self):
+        from happy.acl import filter_permitted
+        from happy.acl import has_permission
+        from happy.acl import ALL_PERMISSIONS
+        from happy.acl import Allow
+        from happy.acl import Deny
+        from happy.acl import Everyone
+        import webob
+        request = webob.Request.blank('/')
+        request.remote_user = 'chris'
+        request.authenticated_principals = ['chris']
+        root = CountingModel()
+        root.__acl__ = [(Allow, 'chris', ['view']),
+                        (Deny, Everyone, ALL_PERMISSIONS)]
+        folder = root['folder'] = DummyModel()
+        children = []
+        for i in range(6):
+            child = folder[str(i)] = DummyModel()
+            children.append(child)
+        children[1].__acl__ = [(Deny, 'chris', ['view'])]
+        children[2].__acl__ = [(Allow, 'paul', ['view'])]
+        other = DummyModel()
+        other.__acl__ = [(Allow, Everyone, ['view'])]
+        contexts = children + [other, folder]
+
+        permitted = filter_permitted(request, 'view', contexts)
+        self.failIf(isinstance(permitted, list))
+        permitted = list(permitted)
+        self.assertEqual(root.acl_reads, 1)
+        self.assertEqual(map(id, permitted), [
+            id(context) for context in contexts
+            if has_permission(request, 'view', context)
+        ])
+        self.assertEqual(map(id, permitted), map(id, [
+            children[0], children[2], children[3], children[4], children[5],
+            other, folder]))
+        self.assertEqual(
+            list(filter_permitted(request, 'edit', contexts)), [])
+
+class TestACLIndex(unittest.TestCase):
+    def test_index(self):
+        from happy.acl import ACLIndex
+        from happy.acl import may
+        from happy.acl import ALL_PERMISSIONS
+        from happy.acl import Allow
+        from happy.acl import Deny
+        from happy.acl import Everyone
+        root = CountingModel()
+        root.__acl__ = [(Allow, 'group.Admin', ALL_PERMISSIONS),
+                        (Allow, Everyone, ['view']),
+                        (Deny, Everyone, ALL_PERMISSIONS)]
+        a = root['a'] = DummyModel()
+        a.__acl__ = [(Allow, 'chris', ['edit']),
+                     (Allow, Everyone, ['view']),
+                     (Allow, 'chris', ['edit'])]
+        b = a['b'] = DummyModel()
+        c = root['c'] = DummyModel()
+        c.__acl__ = [(Deny, Everyone, ['view'])]
+
+        index = ACLIndex()
+        cases = [
+            (['chris', Everyone], 'edit'),
+            (['chris', Everyone], 'view'),
+            (['paul', Everyone], 'edit'),
+            (['group.Admin', Everyone], 'view'),
+        ]
+        contexts = (b, c, a, root)
+        results = [index.may(principals, permission, context)
+                   for context in contexts
+                   for principals, permission in cases]
+        self.assertEqual(root.acl_reads, 1)
+        self.assertEqual(results, [may(principals, permission, context)
+                                   for context in contexts
+                                   for principals, permission in cases])
+        self.assertEqual(list(index.effective_acl(b)), [
+            (Allow, 'chris', ['edit']),
+            (Allow, Everyone, ['view']),
+            (Allow, 'group.Admin', ALL_PERMISSIONS),
+            (Deny, Everyone, ALL_PERMISSIONS),
+        ])
+
+        # Changed acl is ignored until invalidated
+        a.__acl__ = [(Deny, 'chris', ['edit'])]
+        self.failUnless(index.may(['chris'], 'edit', b))
+        index.invalidate(a)
+        self.failIf(index.may(['chris'], 'edit', b))
+        self.failUnless(index.may(['chris', Everyone], 'view', c) is False)
+
+        # Move b under c
+        index.invalidate(b)
+        del a['b']
+        c['b'] = b
+        self.failIf(index.may(['chris', Everyone], 'view', b))
+
+        index.invalidate()
+        self.assertEqual(index._index, {})
+
+class TestACLBits(unittest.TestCase):
+    def test_bits(self):
+        from happy.acl import ACLBits
+        from happy.acl import may
+        from happy.acl import ALL_PERMISSIONS
+        from happy.acl import Allow
+        from happy.acl import Deny
+        from happy.acl import Everyone
+        root = DummyModel()
+        root.__acl__ = [(Allow, 'group.Admin', ALL_PERMISSIONS),
+                        (Allow, 'group.Editors', ['view', 'edit']),
+                        (Allow, 'group.Authors', ['edit', 'view']),
+                        (Allow, Everyone, 'view'),
+                        (Deny, Everyone, ALL_PERMISSIONS)]
+        a = root['a'] = DummyModel()
+        a.__acl__ = [(Deny, 'chris', ['edit']),
+                     (Allow, 'paul', ['publish'])]
+        b = a['b'] = DummyModel()
+
+        bits = ACLBits(['view', 'edit', 'delete'])
+        self.assertEqual(len(bits.encode_acl(root.__acl__)), 4)
+        self.assertEqual(len(bits.encode_acl(a.__acl__)), 1)
+        for principals in (['chris', 'group.Editors'], ['group.Admin'],
+                           ['paul', Everyone], ['chris', 'group.Authors']):
+            encoded = bits.encode_principals(principals)
+            for permission in ('view', 'edit', 'delete'):
+                for context in (root, a, b):
+                    self.assertEqual(
+                        bits.may(encoded, permission, context),
+                        may(principals, permission, context))
+        self.assertRaises(ValueError, bits.may, 0, 'publish', b)
+
+        encoded = bits.encode_principals(['chris', 'group.Editors'])
+        a.__acl__.append((Allow, 'chris', ['delete']))
+        self.failIf(bits.may(encoded, 'delete', b))
+        bits.forget(a.__acl__)
+        self.failUnless(bits.may(encoded, 'delete', b))
+
+    def test_cache_size(self):
+        from happy.acl import ACLBits
+        from happy.acl import Allow
+        bits = ACLBits(['view'])
+        bits.max_cache_size = 2
+        encoded = bits.encode_principals([])
+        for i in xrange(5):
+            model = DummyModel()
+            model.__acl__ = [(Allow, 'chris', ['view'])]
+            self.failIf(bits.may(encoded, 'view', model))
+            self.failUnless(len(bits._acls) <= 2)
+
+        bits.max_cache_size = 0
+        bits.clear()
+        self.failUnless(bits.may(bits.encode_principals(['chris']), 'view',
+                                 model))
+        self.assertEqual(bits._acls, {})
+
+    def test_unknown_principals(self):
+        from happy.acl import ACLBits
+        from happy.acl import Allow
+        from happy.acl import Everyone
+        root = DummyModel()
+        root.__acl__ = [(Allow, Everyone, ['view'])]
+        a = root['a'] = DummyModel()
+        a.__acl__ = [(Allow, 'fred', ['edit'])]
+
+        bits = ACLBits(['view', 'edit'])
+        bits.encode_acl(root.__acl__)
+        for i in xrange(100):
+            bits.encode_principals(['user%d' % i, Everyone])
+        self.assertEqual(bits._principals.keys(), [Everyone])
+
+        # Principal is introduced by an ACL encoded after the principals
+        encoded = bits.encode_principals(['fred', Everyone])
+        self.failUnless(bits.may(encoded, 'view', root))
+        self.failIf(bits.may(encoded, 'edit', root))
+        self.failUnless(bits.may(encoded, 'edit', a))
+        self.assertEqual(encoded.n_principals, 2)
+        self.failUnless(bits.may(encoded, 'edit', a))
+        self.failIf(bits.may(bits.encode_principals(['paul']), 'edit', a))
+        self.assertEqual(len(bits._principals), 2)
+
 class TestPrincipalsWithPermission(unittest.TestCase):
     def setUp(self):
         from happy.acl import principals_with_permission
@@ -112,8 +363,56 @@ class TestPrincipalsWithPermission(unittest.TestCase):
                      (Allow, 'paul', ['view'])]
         self.assertEqual(self.fut('view', c), set(['paul', 'tres']))
 
+class TestPrincipalsWithPermissions(unittest.TestCase):
+    def test_bulk(self):
+        from happy.acl import principals_with_permission
+        from happy.acl import principals_with_permissions
+        from happy.acl import ALL_PERMISSIONS
+        from happy.acl import Allow
+        from happy.acl import Deny
+        from happy.acl import Everyone
+        a = CountingModel()
+        b = a['b'] = DummyModel()
+        c = b['c'] = DummyModel()
+        d = b['d'] = DummyModel()
+        e = a['e'] = DummyModel()
+        a.__acl__ = [(Allow, 'chris', ['view', 'edit'])]
+        b.__acl__ = [(Deny, 'chris', ['edit']),
+                     (Allow, 'paul', ['view'])]
+        c.__acl__ = [(Deny, Everyone, ALL_PERMISSIONS)]
+        d.__acl__ = [(Allow, 'tres', ['view'])]
+
+        contexts = [a, c, d, e, b]
+        permissions = ['view', 'edit']
+        memo = {}
+        results = principals_with_permissions(permissions, contexts, memo)
+        self.assertEqual(a.acl_reads, 2)
+        self.assertEqual(results, [
+            dict([(permission, principals_with_permission(permission, c))
+                  for permission in permissions])
+            for c in contexts
+        ])
+        self.assertEqual(results[2]['view'], set(['chris', 'paul', 'tres']))
+        self.assertEqual(results[1]['view'], set())
+
+        a.acl_reads = 0
+        principals_with_permissions(permissions, [d, c], memo)
+        self.assertEqual(a.acl_reads, 0)
+
 class DummyModel(dict):
     def __setitem__(self, name, child):
         super(DummyModel, self).__setitem__(name, child)
         child.__name__ = name
         child.__parent__ = self
+
+class CountingModel(DummyModel):
+    acl_reads = 0
+
+    def _get_acl(self):
+        self.acl_reads += 1
+        return self._acl
+
+    def _set_acl(self, acl):
+        self._acl = acl
+
+    __acl__ = property(_get_acl, _set_acl)
@@ -40,3 +40,7 @@ class AdaptationManagerTests(unittest.TestCase):
 
         self.assertRaises(KeyError, manager.adapt, obj, object)
         self.assertRaises(KeyError, manager.adapt, object(), Interface)
+
+        manager.freeze()
+        self.assertEqual(manager.adapt(C(), Interface).__class__, AdapterC)
+        self.assertRaises(ValueError, manager.register, AdapterA, C, A)
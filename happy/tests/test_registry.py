@@ -115,6 +115,210 @@ class RegistryTests(unittest.TestCase):
         self.assertRaises(ValueError, registry.lookup, foo=1)
         self.assertRaises(ValueError, registry.register, 1, 'foo', name='foo')
 
+    def test_lookup_cache(self):
+        from happy.registry import Registry
+        from happy.registry import SimpleAxis
+        from happy.registry import TypeAxis
+        registry = Registry(('type', TypeAxis()),
+                            ('name', SimpleAxis()))
+        registry.register('one', DummyA)
+        self.assertEqual(registry.lookup(DummyB()), 'one')
+        self.assertEqual(registry.lookup(DummyB()), 'one')
+        self.assertEqual(registry.lookup(DummyB(), 'foo'), None)
+        self.assertEqual(registry.lookup(DummyB(), 'foo'), None)
+        self.assertEqual(registry.cache_hits, 2)
+        self.assertEqual(registry.cache_misses, 2)
+
+        registry.register('two', DummyB)
+        self.assertEqual(registry.lookup(DummyB()), 'two')
+        registry.register('three', DummyB, 'foo')
+        self.assertEqual(registry.lookup(DummyB(), 'foo'), 'three')
+        registry.override('four', DummyB, 'foo')
+        self.assertEqual(registry.lookup(DummyB(), 'foo'), 'four')
+        self.assertEqual(registry.cache_hits, 2)
+        self.assertEqual(registry.cache_misses, 5)
+
+    def test_lookup_cache_size(self):
+        from happy.registry import Registry
+        from happy.registry import SimpleAxis
+        registry = Registry(('name', SimpleAxis()))
+        registry.max_cache_size = 2
+        registry.register('foo', 'foo')
+        self.assertEqual(registry.lookup('foo'), 'foo')
+        self.assertEqual(registry.lookup('bar'), None)
+        self.assertEqual(registry.lookup('baz'), None)
+        self.assertEqual(registry.lookup('foo'), 'foo')
+        self.assertEqual(registry.cache_hits, 0)
+        self.assertEqual(registry.cache_misses, 4)
+
+        registry.max_cache_size = 0
+        self.assertEqual(registry.lookup('foo'), 'foo')
+        self.assertEqual(registry.cache_misses, 4)
+
+    def test_uncacheable_axis(self):
+        from happy.registry import Registry
+        from happy.registry import SimpleAxis
+        class UncacheableAxis(object):
+            def matches(self, obj, keys):
+                if obj in keys:
+                    yield obj
+
+        registry = Registry(('one', UncacheableAxis()),
+                            ('two', SimpleAxis()))
+        registry.register('foo', 1, 2)
+        self.assertEqual(registry.lookup(1, 2), 'foo')
+        self.assertEqual(registry.lookup(1, 2), 'foo')
+        self.assertEqual(registry.lookup(two=2), None)
+        self.assertEqual(registry.lookup(two=2), None)
+        self.assertEqual(registry.cache_hits, 1)
+        self.assertEqual(registry.cache_misses, 1)
+
+    def test_unhashable_lookup(self):
+        from happy.registry import Registry
+        from happy.registry import SimpleAxis
+        registry = Registry(('name', SimpleAxis()))
+        registry.register('foo', 'foo')
+        self.assertEqual(registry.lookup(['foo']), None)
+        self.assertEqual(registry.lookup('foo'), 'foo')
+        registry.max_cache_size = 0
+        self.assertEqual(registry.lookup(['foo']), None)
+        registry.max_cache_size = 1000
+        registry.freeze()
+        self.assertEqual(registry.lookup(['foo']), None)
+        self.assertEqual(registry.lookup('foo'), 'foo')
+
+    def test_freeze(self):
+        from happy.registry import Registry
+        from happy.registry import SimpleAxis
+        from happy.registry import TypeAxis
+        registry = Registry(('type', TypeAxis()),
+                            ('name', SimpleAxis()),
+                            ('grade', SimpleAxis()))
+        registry.register('root')
+        registry.register('one', object)
+        registry.register('two', DummyA)
+        registry.register('three', DummyA, 'foo')
+        registry.register('four', object, 'bar')
+        registry.register('five', object, grade=1)
+        registry.register('six', DummyB, 'foo', 2)
+        registry.freeze()
+
+        self.assertEqual(registry.lookup(), 'root')
+        self.assertEqual(registry.lookup(object()), 'one')
+        self.assertEqual(registry.lookup(DummyB()), 'two')
+        self.assertEqual(registry.lookup(DummyB(), 'foo'), 'three')
+        self.assertEqual(registry.lookup(DummyB(), 'bar'), 'four')
+        self.assertEqual(registry.lookup(DummyA(), 'baz'), None)
+        self.assertEqual(registry.lookup(DummyA(), grade=1), 'five')
+        self.assertEqual(registry.lookup(DummyA(), grade=2), None)
+        self.assertEqual(registry.lookup(DummyB(), 'foo', 2), 'six')
+        self.assertEqual(registry.lookup(DummyA(), 'foo', 2), None)
+        self.assertEqual(registry.lookup(name='foo'), None)
+
+        registry.max_cache_size = 0
+        self.assertEqual(registry.lookup(DummyB(), 'foo'), 'three')
+
+        self.assertRaises(ValueError, registry.register, 'seven', DummyB)
+        self.assertRaises(ValueError, registry.override, 'seven', DummyA)
+        self.assertEqual(registry.lookup(DummyB()), 'two')
+
+    def test_cache_key_protocol(self):
+        from happy.registry import Registry
+        from happy.registry import SimpleAxis
+        class CountingAxis(SimpleAxis):
+            calls = 0
+            def matches(self, obj, keys):
+                self.calls += 1
+                return super(CountingAxis, self).matches(obj, keys)
+
+            def cache_key(self, obj):
+                if obj != 'volatile':
+                    return obj
+
+        axis = CountingAxis()
+        registry = Registry(('one', axis), ('two', SimpleAxis()))
+        registry.max_cache_size = 2
+        registry.register('foo', 'foo', 1)
+        registry.register('bar', 'foo', 2)
+        registry.register('baz', 'volatile', 1)
+        self.assertEqual(registry.lookup('foo', 1), 'foo')
+        self.assertEqual(registry.lookup('foo', 2), 'bar')
+        self.assertEqual(registry.lookup('foo', 3), None)
+        self.assertEqual(axis.calls, 1)
+        self.assertEqual(registry.cache_hits, 0)
+
+        self.assertEqual(registry.lookup('volatile', 1), 'baz')
+        self.assertEqual(registry.lookup('volatile', 1), 'baz')
+        self.assertEqual(axis.calls, 3)
+        self.assertEqual(registry.cache_hits, 0)
+
+        registry.register('qux', 'qux', 1)
+        self.assertEqual(registry.lookup('foo', 2), 'bar')
+        self.assertEqual(axis.calls, 4)
+
+        registry.freeze()
+        self.assertEqual(registry.lookup('foo', 1), 'foo')
+        self.assertEqual(registry.lookup('foo', 3), None)
+        self.assertEqual(registry.lookup('qux', 1), 'qux')
+        self.assertEqual(axis.calls, 6)
+
+    def test_overridden_get_keys_not_cached(self):
+        from happy.registry import Registry
+        from happy.registry import SimpleAxis
+        from happy.registry import TypeAxis
+        class KindAxis(SimpleAxis):
+            def get_keys(self, obj):
+                return [obj.kind, 'default']
+
+        class KindTypeAxis(TypeAxis):
+            def get_keys(self, obj):
+                return [obj.kind]
+
+        class Dummy(object):
+            kind = 'foo'
+
+        registry = Registry(('one', KindAxis()))
+        registry.register('foo', 'foo')
+        registry.register('default', 'default')
+        d = Dummy()
+        self.assertEqual(registry.lookup(d), 'foo')
+        d.kind = 'bar'
+        self.assertEqual(registry.lookup(d), 'default')
+
+        class KindMatchesAxis(SimpleAxis):
+            def matches(self, obj, keys):
+                if obj.kind in keys:
+                    yield obj.kind
+
+        registry = Registry(('one', KindMatchesAxis()))
+        registry.register('foo', 'foo')
+        d = Dummy()
+        self.assertEqual(registry.lookup(d), 'foo')
+        d.kind = 'bar'
+        self.assertEqual(registry.lookup(d), None)
+
+        registry = Registry(('one', KindTypeAxis()))
+        registry.register('foo', 'foo')
+        d = Dummy()
+        self.assertEqual(registry.lookup(d), 'foo')
+        d.kind = 'bar'
+        self.assertEqual(registry.lookup(d), None)
+        self.assertEqual(registry.cache_hits, 0)
+
+    def test_extend_type_axis_keys(self):
+        from happy.registry import Registry
+        from happy.registry import TypeAxis
+        class DefaultTypeAxis(TypeAxis):
+            def get_keys(self, obj):
+                keys = super(DefaultTypeAxis, self).get_keys(obj)
+                keys.insert(0, 'default')
+                return keys
+
+        registry = Registry(('type', DefaultTypeAxis()))
+        registry.register('default', 'default')
+        registry.register('a', DummyA)
+        self.assertEqual(registry.lookup(DummyA()), 'default')
+
 class DummyA(object):
     pass
 
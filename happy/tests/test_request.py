@@ -0,0 +1,118 @@
+import unittest
+
+class ScopedRequestTests(unittest.TestCase):
+    def test_attrs_isolated(self):
+        from happy.request import scoped_request
+        import webob
+        request = webob.Request.blank('/foo')
+        request.foo = 'foo'
+        scoped = scoped_request(request)
+        self.failUnless(isinstance(scoped, webob.Request))
+        self.failIf(scoped.environ is request.environ)
+        self.assertEqual(scoped.foo, 'foo')
+
+        scoped.foo = 'bar'
+        scoped.bar = 'bar'
+        self.assertEqual(scoped.foo, 'bar')
+        self.assertEqual(request.foo, 'foo')
+        self.failIf(hasattr(request, 'bar'))
+
+        del scoped.bar
+        self.failIf(hasattr(scoped, 'bar'))
+        self.assertRaises(AttributeError, delattr, scoped, 'bar')
+        del scoped.foo
+        self.failIf(hasattr(scoped, 'foo'))
+        self.assertEqual(request.foo, 'foo')
+
+    def test_attrs_visible_in_environ(self):
+        from happy.request import scoped_request
+        import webob
+        request = webob.Request.blank('/foo')
+        request.foo = 'foo'
+        scoped = scoped_request(request)
+        scoped.bar = 'bar'
+
+        def app(environ, start_response):
+            inner = webob.Request(environ)
+            body = '%s|%s' % (inner.foo, inner.bar)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [body]
+
+        self.assertEqual(scoped.get_response(app).body, 'foo|bar')
+        self.failIf(hasattr(request, 'bar'))
+
+    def test_environ_isolated(self):
+        from happy.request import scoped_request
+        import webob
+        request = webob.Request.blank('/foo/bar')
+        scoped = scoped_request(request)
+        scoped.script_name = '/foo'
+        scoped.path_info = '/bar'
+        self.assertEqual(scoped.url, 'http://localhost/foo/bar')
+        self.assertEqual(request.script_name, '')
+        self.assertEqual(request.path_info, '/foo/bar')
+
+        request.remote_user = 'chris'
+        scoped = scoped_request(request)
+        del scoped.remote_user
+        self.assertEqual(scoped.remote_user, None)
+        self.assertEqual(request.remote_user, 'chris')
+
+    def test_nested(self):
+        from happy.request import scoped_request
+        import webob
+        request = webob.Request.blank('/')
+        outer = scoped_request(request)
+        outer.remote_user = 'chris'
+        outer.foo = 'foo'
+        inner = scoped_request(outer)
+        inner.foo = 'bar'
+        self.assertEqual(inner.remote_user, 'chris')
+        self.assertEqual(inner.foo, 'bar')
+        self.assertEqual(outer.foo, 'foo')
+        self.assertEqual(request.remote_user, None)
+        self.failIf(hasattr(request, 'foo'))
+
+    def test_webob_api(self):
+        from happy.request import scoped_request
+        import webob
+        request = webob.Request.blank('/foo?a=1')
+        request.foo = 'foo'
+        scoped = scoped_request(request)
+        self.assertEqual(scoped.copy().path_info, '/foo')
+        self.assertEqual(scoped.copy_get().GET['a'], '1')
+        self.assertEqual(type(scoped).blank('/bar').path_info, '/bar')
+
+    def test_custom_request_factory(self):
+        from happy.request import scoped_request
+        import webob
+        class MyRequest(webob.Request):
+            def __init__(self, environ, **kw):
+                super(MyRequest, self).__init__(environ, **kw)
+                self._my_attr = 'mine'
+
+        request = webob.Request.blank('/')
+        request.foo = 'foo'
+        scoped = scoped_request(request, MyRequest)
+        self.failUnless(isinstance(scoped, MyRequest))
+        self.failIf(scoped.environ is request.environ)
+        scoped.bar = 'bar'
+        self.assertEqual(scoped._my_attr, 'mine')
+        self.assertEqual(scoped.foo, 'foo')
+
+class ApplicationUrlTests(unittest.TestCase):
+    def test_application_url(self):
+        from happy.request import application_url
+        from happy.request import scoped_request
+        import webob
+        request = webob.Request.blank('/foo', environ={'SCRIPT_NAME': '/app/'})
+        self.assertEqual(application_url(request), 'http://localhost/app')
+        self.failUnless('happy.application_url' in request.environ)
+        self.assertEqual(application_url(request), 'http://localhost/app')
+
+        scoped = scoped_request(request)
+        scoped.script_name = '/app/foo'
+        self.assertEqual(application_url(scoped), 'http://localhost/app/foo')
+        scoped.host = 'example.com'
+        self.assertEqual(application_url(scoped), 'http://example.com/app/foo')
+        self.assertEqual(application_url(request), 'http://localhost/app')
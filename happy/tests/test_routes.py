@@ -25,6 +25,94 @@ class RoutesTests(unittest.TestCase):
                          ['Three', 'lily', 'barf', 'pi'])
         self.assertEqual(d(req('/'), '/foo/bar/none'), None)
 
+    def test_constrained_variables(self):
+        def controller(name):
+            return lambda request: (name, request.match_dict)
+
+        from happy.routes import RoutesDispatcher
+        d = RoutesDispatcher()
+        d.register(controller('slug'), 'slug', '/posts/:slug<[a-z-]+>')
+        d.register(controller('id'), 'id', '/posts/:id<int>')
+        d.register(controller('other'), 'other', '/posts/:other')
+        d.register(controller('edit'), 'edit', '/posts/:id<int>/edit')
+
+        from webob import Request
+        req = Request.blank
+        self.assertEqual(d(req('/posts/happy-days')),
+                         ('slug', {'slug': 'happy-days'}))
+        self.assertEqual(d(req('/posts/42')), ('id', {'id': 42}))
+        self.assertEqual(d(req('/posts/42/edit')), ('edit', {'id': 42}))
+        self.assertEqual(d(req('/posts/Happy42')),
+                         ('other', {'other': 'Happy42'}))
+        self.assertEqual(d(req('/posts/Happy42/edit')), None)
+        self.assertEqual(d(req('/posts/:id<int>')),
+                         ('other', {'other': ':id<int>'}))
+        self.assertEqual(d(req('/posts/:<int>/edit')), None)
+        self.assertEqual(d(req('/posts/happy%0A')),
+                         ('other', {'other': 'happy\n'}))
+        self.assertEqual(d(req('/posts/42%0A/edit')), None)
+
+        items = RoutesDispatcher()
+        items.register(controller('id'), 'id', '/items/:id<int>')
+        self.assertEqual(items(req('/items/:<int>')), None)
+        self.assertEqual(items(req('/items/7')), ('id', {'id': 7}))
+
+        request = req('/')
+        self.assertEqual(d['edit'].url(request, id=42),
+                         'http://localhost/posts/42/edit')
+
+    def test_backtracking(self):
+        def controller(name):
+            return lambda request: (name, request.match_dict, request.subpath)
+
+        from happy.routes import RoutesDispatcher
+        d = RoutesDispatcher()
+        d.register(controller('bar'), 'bar', '/foo/bar/y')
+        d.register(controller('animal'), 'animal', '/foo/:animal/x')
+        d.register(controller('id'), 'id', '/foo/:id<int>/z')
+        d.register(controller('barplus'), 'barplus', '/foo/bar/baz/*')
+        d.register(controller('fooplus'), 'fooplus', '/foo/*')
+
+        from webob import Request
+        req = Request.blank
+        self.assertEqual(d(req('/foo/bar/y')), ('bar', {}, []))
+        self.assertEqual(d(req('/foo/bar/x')),
+                         ('animal', {'animal': 'bar'}, []))
+        self.assertEqual(d(req('/foo/7/x')), ('animal', {'animal': '7'}, []))
+        self.assertEqual(d(req('/foo/7/z')), ('id', {'id': 7}, []))
+        self.assertEqual(d(req('/foo/bar/baz/x')), ('barplus', {}, ['x']))
+        self.assertEqual(d(req('/foo/bar/z')),
+                         ('fooplus', {}, ['bar', 'z']))
+        self.assertEqual(d(req('/foo/7/y')), ('fooplus', {}, ['7', 'y']))
+        self.assertEqual(d(req('/bar')), None)
+
+    def test_match_cache(self):
+        def controller(request, a):
+            request.match_dict['a'] = 'mutated'
+            request.subpath.append('mutated')
+            return a, request.subpath
+
+        from happy.routes import RoutesDispatcher
+        d = RoutesDispatcher(cache_size=2)
+        d.register(controller, 'a', '/foo/:a/*')
+
+        from webob import Request
+        req = Request.blank
+        self.assertEqual(d(req('/foo/bar/baz')), ('bar', ['baz', 'mutated']))
+        self.assertEqual(d(req('/foo/bar/baz')), ('bar', ['baz', 'mutated']))
+        self.assertEqual(d(req('/bar')), None)
+        self.assertEqual(d(req('/bar')), None)
+        self.assertEqual((d.cache_hits, d.cache_misses), (2, 2))
+
+        self.assertEqual(d(req('/foo/a')), ('a', ['mutated']))
+        self.assertEqual(d(req('/bar')), None)
+        self.assertEqual(d(req('/foo/bar/baz')), ('bar', ['baz', 'mutated']))
+        self.assertEqual((d.cache_hits, d.cache_misses), (3, 4))
+
+        d.register(lambda request: 'bar', 'bar', '/bar')
+        self.assertEqual(d(req('/bar')), 'bar')
+        self.assertEqual((d.cache_hits, d.cache_misses), (3, 5))
+
     def test_no_match(self):
         controller = lambda x: x
         from happy.routes import RoutesDispatcher
@@ -98,6 +186,9 @@ class RoutesTests(unittest.TestCase):
         from webob import Request
         self.assertEqual(d(Request.blank('/')), 'Hello')
 
+        from happy.view import REQUEST_ONLY
+        self.assertEqual(d['root'].convention, REQUEST_ONLY)
+
     def test_preserve_trailing_slash(self):
         controller1 = lambda request: (1, request.url)
         controller2 = lambda request: (2, request.url)
@@ -140,6 +231,26 @@ class RoutesTests(unittest.TestCase):
         self.assertEqual(three.url(request, bar='booze'),
                          'http://localhost/foo/booze/')
 
+    def test_urls(self):
+        controller = lambda x: x
+
+        from happy.routes import RoutesDispatcher
+        d = RoutesDispatcher()
+        route = d.register(controller, 'post', '/posts/:id<int>/:slug/*')
+
+        import webob
+        request = webob.Request.blank('/', environ={'SCRIPT_NAME': '/blog'})
+        match_dicts = [
+            {'id': 1, 'slug': 'one'},
+            {'id': 2, 'slug': 'two', 'subpath': ['edit']},
+        ]
+        self.assertEqual(route.urls(request, match_dicts), [
+            'http://localhost/blog/posts/1/one/',
+            'http://localhost/blog/posts/2/two/edit',
+        ])
+        self.assertEqual(match_dicts[1]['subpath'], ['edit'])
+        self.assertEqual(route.urls(request, []), [])
+
     def test_override(self):
         def controller(foo):
             def wrapper(request):
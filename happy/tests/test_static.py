@@ -113,6 +113,40 @@ class TestFileResponse(unittest.TestCase):
 
         self.assertEqual(got, expected)
 
+    def test_file_wrapper(self):
+        from happy.static import FileResponse
+        from wsgiref.util import FileWrapper
+        import webob
+        fpath = self._mktestfile(800)
+        expected = open(fpath, 'rb').read()
+        environ = {'wsgi.file_wrapper': FileWrapper}
+
+        request = webob.Request.blank('/', environ=environ)
+        response = FileResponse(fpath, request, buffer_size=300)
+        self.failUnless(isinstance(response.app_iter, FileWrapper))
+        self.assertEqual(response.app_iter.filelike._file, None) # Not opened
+        self.assertEqual(map(len, response.app_iter), [300, 300, 200])
+        response.app_iter.close()
+
+        # Discarded without being served
+        FileResponse(fpath, request).app_iter.close()
+
+        response = FileResponse(fpath, request)
+        self.assertEqual(response.body, expected)
+        self.assertEqual(response.content_length, 800)
+
+        request = webob.Request.blank('/', environ=environ)
+        request.headers['Range'] = 'bytes=100-449'
+        response = FileResponse(fpath, request, buffer_size=300)
+        app_iter = response.app_iter
+        self.failUnless(isinstance(app_iter, FileWrapper))
+        import os
+        fileno = app_iter.filelike.fileno()
+        self.assertEqual(os.lseek(fileno, 0, os.SEEK_CUR), 100)
+        self.assertEqual(response.body, expected[100:450])
+        self.assertEqual(response.content_length, 350)
+        self.assertEqual(response.status_int, 206)
+
     def test_multiple_ranges_not_supported(self):
         from happy.static import FileResponse
         import webob
@@ -40,6 +40,144 @@ class TraversalTests(unittest.TestCase):
         self.assertEqual(f(root, '/b/c'), c)
         self.assertRaises(KeyError, f, root, '/b/c/d/e')
 
+    def test_traverse_many_hook(self):
+        from happy.traversal import traverse as f
+        from happy.traversal import TraversalCache
+        root = DummyModel()
+        a = root['a'] = BatchModel()
+        b = a['b'] = DummyModel()
+        c = b['c'] = DummyModel()
+        d = c['d'] = BatchModel()
+        e = d['e'] = DummyLeaf()
+
+        self.assertEqual(f(root, '/a/b/c/d/e/f'), (e, ['f']))
+        self.assertEqual(a.calls, [])
+
+        self.assertEqual(f(root, '/a/b/c/d/e/f', prefetch=True), (e, ['f']))
+        self.assertEqual(a.calls, [['b', 'c', 'd', 'e', 'f']])
+        self.assertEqual(d.calls, [['e', 'f']])
+        self.assertEqual(f(root, '/a/x/y', prefetch=True), (a, ['x', 'y']))
+        self.assertEqual(f(root, '/a/b/x', prefetch=True), (b, ['x']))
+
+        cache = TraversalCache()
+        self.assertEqual(f(root, '/a/b/c', cache, True), (c, []))
+        self.assertEqual(cache.lookup(root, ['a', 'b']), (b, 2))
+
+    def test_traverse_many(self):
+        from happy.traversal import traverse
+        from happy.traversal import traverse_many as f
+        root = DummyModel()
+        a = root['a'] = DummyModel()
+        b = a['b'] = CountingModel()
+        c = b['c'] = DummyModel()
+        d = b['d'] = DummyLeaf()
+        e = root['e'] = DummyModel()
+
+        paths = ['/a/b/d/f', '/', '/a/b/c', '/e/x/y', '/a/b/c/', '/a',
+                 '/a/b/x', '/a/b/d']
+        results = f(root, paths)
+        self.assertEqual(b.calls, 3)
+        self.assertEqual(results, [traverse(root, path) for path in paths])
+        self.assertEqual(results[0], (d, ['f']))
+        self.assertEqual(results[3], (e, ['x', 'y']))
+        self.failIf(results[2][1] is results[4][1])
+        self.assertEqual(f(root, []), [])
+
+    def test_traverse_many_with_hooks(self):
+        from happy.traversal import traverse
+        from happy.traversal import traverse_many as f
+        root = DummyModel()
+        a = root['a'] = BatchModel()
+        b = a['b'] = DummyModel()
+        c = b['c'] = DummyModel()
+        d = c['d'] = DummyLeaf()
+        y = DummyLeaf()
+        z = DummyLeaf()
+        x = root['x'] = HookOnlyModel({'y': (y, {'z': (z, {})})})
+
+        paths = ['/a/b/c/d/e', '/a/b/c', '/a/q', '/x/y/z', '/x/y', '/x/q',
+                 '/a/b']
+        results = f(root, paths, prefetch=True)
+        self.assertEqual(results,
+                         [traverse(root, path, prefetch=True)
+                          for path in paths])
+        self.assertEqual(results[0], (d, ['e']))
+        self.assertEqual(results[2], (a, ['q']))
+        self.assertEqual(results[3], (z, []))
+        self.assertEqual(results[4], (y, []))
+        self.assertEqual(results[5], (x, ['q']))
+
+        n_calls = len(a.calls)
+        results = f(root, paths)
+        self.assertEqual(results, [traverse(root, path) for path in paths])
+        self.assertEqual(results[3], (x, ['y', 'z']))
+        self.assertEqual(len(a.calls), n_calls)
+
+    def test_traverse_with_cache(self):
+        from happy.traversal import traverse as f
+        from happy.traversal import TraversalCache
+        root = DummyModel()
+        a = root['a'] = DummyModel()
+        b = a['b'] = CountingModel()
+        c = b['c'] = DummyModel()
+        d = c['d'] = DummyLeaf()
+
+        cache = TraversalCache()
+        self.assertEqual(f(root, '/a/b/c/d/e', cache), (d, ['e']))
+        self.assertEqual(b.calls, 1)
+        self.assertEqual(f(root, '/a/b/c/d/e', cache), (d, ['e']))
+        self.assertEqual(f(root, '/a/b/c', cache), (c, []))
+        self.assertEqual(f(root, '/a/b/x', cache), (b, ['x']))
+        self.assertEqual(b.calls, 2)
+
+        # Different root
+        other = DummyModel()
+        self.assertEqual(f(other, '/a/b', cache), (other, ['a', 'b']))
+
+        # Explicit invalidation
+        c2 = b['c'] = DummyModel()
+        self.assertEqual(f(root, '/a/b/c', cache), (c, []))
+        cache.invalidate('/a/b/c')
+        self.assertEqual(f(root, '/a/b/c', cache), (c2, []))
+        self.assertEqual(f(root, '/a/b/c/d', cache), (c2, ['d']))
+        cache.invalidate()
+        self.assertEqual(cache.lookup(root, ['a']), (root, 0))
+
+    def test_traversal_cache_ttl(self):
+        from happy.traversal import TraversalCache
+        root = DummyModel()
+        a = DummyModel()
+        now = [0]
+        cache = TraversalCache(ttl=10)
+        cache._now = lambda: now[0]
+        cache.store(root, ['a'], a)
+        now[0] = 9
+        self.assertEqual(cache.lookup(root, ['a', 'b']), (a, 1))
+        now[0] = 10
+        self.assertEqual(cache.lookup(root, ['a', 'b']), (root, 0))
+
+        # Expired entry removed concurrently, by another thread
+        class RacingDict(dict):
+            def get(self, key, default=None):
+                value = dict.get(self, key, default)
+                self.pop(key, None)
+                return value
+        cache._cache = RacingDict()
+        cache.store(root, ['a'], a)
+        now[0] = 20
+        self.assertEqual(cache.lookup(root, ['a', 'b']), (root, 0))
+
+    def test_traversal_cache_max_size(self):
+        from happy.traversal import TraversalCache
+        root = DummyModel()
+        cache = TraversalCache(max_size=2)
+        cache.store(root, ['a'], 'a')
+        cache.store(root, ['b'], 'b')
+        self.assertEqual(cache.lookup(root, ['a']), ('a', 1))
+        cache.store(root, ['c'], 'c')
+        self.assertEqual(cache.lookup(root, ['a']), (root, 0))
+        self.assertEqual(cache.lookup(root, ['c']), ('c', 1))
+
 class TraversalDispatcherTests(unittest.TestCase):
     def test_default_view(self):
         root = DummyModel()
@@ -87,6 +225,72 @@ class TraversalDispatcherTests(unittest.TestCase):
         self.assertEqual(request.subpath, ['foo', 'bar'])
         self.assertEqual(context, root)
 
+    def test_request_only_view(self):
+        root = DummyModel()
+        root_factory = lambda request: root
+        from happy.traversal import TraversalDispatcher
+        dispatcher = TraversalDispatcher(root_factory)
+        def view(request):
+            return request.context
+        dispatcher.register(view, DummyModel)
+        from webob import Request
+        self.assertEqual(dispatcher(Request.blank('/')), root)
+
+    def test_prefetch(self):
+        root = DummyModel()
+        a = root['a'] = BatchModel()
+        b = a['b'] = DummyModel()
+        root_factory = lambda request: root
+        from happy.traversal import TraversalDispatcher
+        from webob import Request
+        dispatcher = TraversalDispatcher(root_factory)
+        dispatcher.register(lambda request, context: context, DummyModel)
+        self.failUnless(dispatcher(Request.blank('/a/b')) is b)
+        self.assertEqual(a.calls, [])
+
+        dispatcher = TraversalDispatcher(root_factory, prefetch=True)
+        dispatcher.register(lambda request, context: context, DummyModel)
+        self.failUnless(dispatcher(Request.blank('/a/b')) is b)
+        self.assertEqual(a.calls, [['b']])
+
+    def test_convention_determined_at_registration(self):
+        root = DummyModel()
+        root_factory = lambda request: root
+        from happy import traversal
+        from happy.view import ViewRegistry
+        registry = ViewRegistry()
+        dispatcher = traversal.TraversalDispatcher(root_factory, registry)
+        dispatcher.register(lambda request: 'one', DummyModel)
+        registry.register(lambda request, context: 'two', DummyModel, 'two')
+
+        inspected = []
+        calling_convention = traversal.calling_convention
+        def counting_convention(view):
+            inspected.append(view)
+            return calling_convention(view)
+        traversal.calling_convention = counting_convention
+        try:
+            from webob import Request
+            self.assertEqual(dispatcher(Request.blank('/')), 'one')
+            self.assertEqual(inspected, [])
+            self.assertEqual(dispatcher(Request.blank('/two')), 'two')
+            self.assertEqual(len(inspected), 1)
+        finally:
+            traversal.calling_convention = calling_convention
+
+    def test_freeze(self):
+        root = DummyModel()
+        root_factory = lambda request: root
+        from happy.traversal import TraversalDispatcher
+        dispatcher = TraversalDispatcher(root_factory)
+        dispatcher.register(lambda request, context: 'Hello', DummyModel)
+        dispatcher.freeze()
+        self.assertRaises(ValueError, dispatcher.register,
+                          lambda request, context: 'Hi', DummyModel, 'hi')
+
+        from webob import Request
+        self.assertEqual(dispatcher(Request.blank('/')), 'Hello')
+
 class TestModelURL(unittest.TestCase):
     def test_it(self):
         root = DummyModel()
@@ -102,6 +306,29 @@ class TestModelURL(unittest.TestCase):
         self.assertEqual(model_url(req, c, 'foo', 'bar'),
                          'http://localhost/b/c/foo/bar')
 
+    def test_memo(self):
+        root = DummyModel()
+        b = root['b'] = DummyModel()
+        c = b['c'] = DummyModel()
+        d = b['d'] = DummyLeaf()
+
+        import webob
+        req = webob.Request.blank('/')
+
+        from happy.traversal import model_path
+        from happy.traversal import model_url
+        memo = {}
+        self.assertEqual(model_path(c, memo=memo), '/b/c/')
+        self.assertEqual(len(memo), 3)
+        self.assertEqual(model_path(d, memo=memo), '/b/d')
+        self.assertEqual(model_path(d, 'e', memo=memo), '/b/d/e')
+        self.assertEqual(model_path(root, memo=memo), '/')
+        self.assertEqual(len(memo), 4)
+        self.assertEqual(model_url(req, c, 'foo', memo=memo),
+                         'http://localhost/b/c/foo')
+        self.assertEqual(model_path(d), '/b/d')
+        self.assertRaises(TypeError, model_path, d, foo='bar')
+
 class DummyModel(dict):
     def __setitem__(self, name, value):
         super(DummyModel, self).__setitem__(name, value)
@@ -114,5 +341,52 @@ class DummyModel(dict):
 class DummyLeaf(object):
     pass
 
+class BatchModel(DummyModel):
+    """
+    Resolves as many segments as it can, but only through plain
+    DummyModels, as a database backed container might.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __traverse_many__(self, segments):
+        self.calls.append(segments)
+        nodes = []
+        node = self
+        for segment in segments:
+            if node is not self and type(node) is not DummyModel:
+                break
+            if segment not in node:
+                break
+            node = dict.__getitem__(node, segment)
+            nodes.append(node)
+        return nodes
+
+class HookOnlyModel(object):
+    """
+    A container which can only be traversed with ``__traverse_many__``.
+    Resolves as many segments as it can through its nested ``children``
+    dicts.
+    """
+    def __init__(self, children):
+        self.children = children
+
+    def __traverse_many__(self, segments):
+        nodes = []
+        children = self.children
+        for segment in segments:
+            if segment not in children:
+                break
+            node, children = children[segment]
+            nodes.append(node)
+        return nodes
+
+class CountingModel(DummyModel):
+    calls = 0
+
+    def __getitem__(self, name):
+        self.calls += 1
+        return super(CountingModel, self).__getitem__(name)
+
 class DummyModelSubclass(DummyModel):
     pass
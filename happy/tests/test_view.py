@@ -37,6 +37,44 @@ class TestViewRegistry(unittest.TestCase):
         registry.register('foo_view', name='foo')
         self.assertEqual(registry.get_registration(name='foo'), 'foo_view')
 
+    def test_get_registration_with_predicates(self):
+        from happy.view import ViewRegistry
+        registry = ViewRegistry()
+        registry.register('get_view', Dummy, request_method='GET')
+        registry.register('view', Dummy)
+        self.assertEqual(registry.get_registration(Dummy), 'view')
+        self.assertEqual(
+            registry.get_registration(Dummy, request_method='GET'),
+            'get_view')
+        self.assertEqual(
+            registry.get_registration(Dummy, request_method='POST'), None)
+
+    def test_lookup_cache(self):
+        from happy.view import ViewRegistry
+        from webob import Request
+        registry = ViewRegistry()
+        registry.register('get_view', Dummy, request_method='GET')
+        registry.register('post_view', Dummy, request_method='POST')
+        registry.register('xhr_view', Dummy, xhr=True)
+        registry.register('submit_view', Dummy, request_method='POST',
+                          request_param='submit')
+        request = Request.blank('/')
+        self.assertEqual(registry.lookup(request, Dummy()), 'get_view')
+        self.assertEqual(registry.lookup(Request.blank('/'), Dummy()),
+                         'get_view')
+        request = Request.blank('/', POST={'submit': 'submit'})
+        self.assertEqual(registry.lookup(request, Dummy()), 'submit_view')
+        request = Request.blank('/', POST={'cancel': 'cancel'})
+        self.assertEqual(registry.lookup(request, Dummy()), 'post_view')
+        request = Request.blank('/', POST={'submit': 'submit'})
+        self.assertEqual(registry.lookup(request, Dummy()), 'submit_view')
+        request = Request.blank('/', method='PUT')
+        request.headers['X-Requested-With'] = 'XMLHttpRequest'
+        self.assertEqual(registry.lookup(request, Dummy()), 'xhr_view')
+        # POST lookups aren't cached, since request_param isn't cacheable
+        self.assertEqual(registry.cache_hits, 1)
+        self.assertEqual(registry.cache_misses, 2)
+
     def test_by_type_and_name(self):
         from happy.view import ViewRegistry
         from webob import Request
@@ -93,6 +131,197 @@ class TestViewRegistry(unittest.TestCase):
         request.POST['version'] = 'alt'
         self.assertEqual(registry.lookup(request, Dummy()), 'alt_view')
 
+    def test_by_query_param(self):
+        from happy.view import ViewRegistry
+        from webob import Request
+        registry = ViewRegistry()
+        registry.register('show_view', Dummy)
+        registry.register('query_view', Dummy, query_param='version=alt')
+        request = Request.blank('/', POST={'version': 'alt'})
+        self.assertEqual(registry.lookup(request, Dummy()), 'show_view')
+        request = Request.blank('/?version=alt', POST={'version': 'normal'})
+        self.assertEqual(registry.lookup(request, Dummy()), 'query_view')
+
+    def test_by_post_param(self):
+        from happy.view import ViewRegistry
+        from webob import Request
+        registry = ViewRegistry()
+        registry.register('show_view', Dummy)
+        registry.register('post_view', Dummy, post_param='submit')
+        request = Request.blank('/?submit=1')
+        self.assertEqual(registry.lookup(request, Dummy()), 'show_view')
+        request = Request.blank('/', POST={'submit': '1'})
+        self.assertEqual(registry.lookup(request, Dummy()), 'post_view')
+
+    def test_request_param_prefers_query_string(self):
+        from happy.view import ViewRegistry
+        class DummyRequest(object):
+            method = 'POST'
+            headers = {}
+            GET = {'version': 'alt'}
+            @property
+            def POST(self):
+                raise AssertionError('body parsed')
+
+        registry = ViewRegistry()
+        registry.register('submit_view', Dummy, request_param='version')
+        registry.register('alt_view', Dummy, request_param='version=alt')
+        self.assertEqual(registry.lookup(DummyRequest(), Dummy()),
+                         'submit_view')
+
+    def test_by_param_value_with_equals(self):
+        from happy.view import ViewRegistry
+        from webob import Request
+        registry = ViewRegistry()
+        registry.register('show_view', Dummy)
+        registry.register('eq_view', Dummy, request_param='expr=a=b')
+        request = Request.blank('/?expr=a')
+        self.assertEqual(registry.lookup(request, Dummy()), 'show_view')
+        request = Request.blank('/?expr=a%3Db')
+        self.assertEqual(registry.lookup(request, Dummy()), 'eq_view')
+
+    def test_tie_goes_to_first_registration(self):
+        from happy.view import ViewRegistry
+        from webob import Request
+        request = Request.blank('/')
+        registry = ViewRegistry()
+        registry.register('get_view', Dummy, request_method='GET')
+        registry.register('not_xhr_view', Dummy, xhr=False)
+        self.assertEqual(registry.lookup(request, Dummy()), 'get_view')
+
+        registry = ViewRegistry()
+        registry.register('not_xhr_view', Dummy, xhr=False)
+        registry.register('get_view', Dummy, request_method='GET')
+        registry.override('get_view2', Dummy, request_method='GET')
+        self.assertEqual(registry.lookup(request, Dummy()), 'not_xhr_view')
+
+    def test_other_methods_not_evaluated(self):
+        from happy.view import ViewRegistry
+        class DummyRequest(object):
+            method = 'GET'
+            headers = {}
+            @property
+            def params(self):
+                raise AssertionError('params accessed')
+
+        registry = ViewRegistry()
+        registry.register('get_view', Dummy, request_method='GET')
+        registry.register('submit_view', Dummy, request_method='POST',
+                          request_param='submit')
+        registry.register('put_view', Dummy, request_method='PUT')
+        self.assertEqual(registry.lookup(DummyRequest(), Dummy()), 'get_view')
+        registry.max_cache_size = 0
+        self.assertEqual(registry.lookup(DummyRequest(), Dummy()), 'get_view')
+
+    def test_body_not_parsed_for_cache_key(self):
+        from happy.view import ViewRegistry
+        from webob import Request
+        registry = ViewRegistry()
+        registry.register('view_a', Dummy, request_method='POST', xhr=True)
+        registry.register('view_b', Dummy, request_method='POST',
+                          post_param='file')
+
+        class CountingRequest(Request):
+            post_reads = 0
+            def _get_POST(self):
+                self.post_reads += 1
+                return Request.POST.fget(self)
+            POST = property(_get_POST)
+
+        request = CountingRequest.blank('/', POST={'file': 'x'})
+        request.headers['X-Requested-With'] = 'XMLHttpRequest'
+        for i in range(3):
+            self.assertEqual(registry.lookup(request, Dummy()), 'view_a')
+        self.assertEqual(request.post_reads, 0)
+
+    def test_cache_key_computed_once(self):
+        from happy.view import ViewRegistry
+        from webob import Request
+        calls = []
+        def counting_predicate(value):
+            def test(request):
+                calls.append(value)
+                return True
+            return test
+
+        registry = ViewRegistry()
+        registry.add_predicate('counted', counting_predicate)
+        registry.register('view_a', Dummy, counted='a')
+        registry.lookup(Request.blank('/'), Dummy())
+        self.assertEqual(len(calls), 2) # Cache key, then match
+        registry.lookup(Request.blank('/'), Dummy())
+        self.assertEqual(len(calls), 3) # Cache key only
+
+    def test_frozen_lookup_evaluates_lazily(self):
+        from happy.view import ViewRegistry
+        from webob import Request
+        calls = []
+        def predicate(name):
+            def factory(value):
+                def test(request):
+                    calls.append(name)
+                    return value
+                return test
+            return factory
+
+        registry = ViewRegistry()
+        registry.add_predicate('cheap', predicate('cheap'), cacheable=False)
+        registry.add_predicate('expensive', predicate('expensive'),
+                               cacheable=False)
+        registry.register('cheap_view', Dummy, cheap=True)
+        registry.register('expensive_view', Dummy, expensive=True)
+        self.assertEqual(registry.lookup(Request.blank('/'), Dummy()),
+                         'cheap_view')
+        self.assertEqual(calls, ['cheap'])
+
+        registry.freeze()
+        del calls[:]
+        self.assertEqual(registry.lookup(Request.blank('/'), Dummy()),
+                         'cheap_view')
+        self.assertEqual(calls, ['cheap'])
+        self.assertEqual(registry.lookup(Request.blank('/'), Dummy(), 'x'),
+                         None)
+        self.assertEqual(calls, ['cheap']) # No view named 'x', so no tests
+
+    def test_add_predicate(self):
+        from happy.view import ViewRegistry
+        from webob import Request
+        calls = []
+        def host_predicate(host):
+            def test(request):
+                calls.append(('host', host))
+                return request.host == host
+            return test
+
+        def path_predicate(path):
+            def test(request):
+                calls.append(('path', path))
+                return request.path_info == path
+            return test
+
+        registry = ViewRegistry()
+        registry.add_predicate('host', host_predicate, cost=0)
+        registry.add_predicate('path', path_predicate, cost=20,
+                               cacheable=False)
+        self.assertRaises(ValueError, registry.add_predicate, 'host',
+                          host_predicate)
+        registry.register('view', Dummy)
+        registry.register('example_view', Dummy, host='example.com')
+        registry.register('foo_view', Dummy, host='localhost:80',
+                          path='/foo')
+
+        request = Request.blank('/foo')
+        self.assertEqual(registry.lookup(request, Dummy()), 'foo_view')
+        request = Request.blank('/bar')
+        self.assertEqual(registry.lookup(request, Dummy()), 'view')
+        request = Request.blank('/foo', environ={'HTTP_HOST': 'example.com'})
+        del calls[:]
+        self.assertEqual(registry.lookup(request, Dummy()), 'example_view')
+        self.assertEqual(calls, [('host', 'localhost:80'),
+                                 ('host', 'example.com')])
+        self.assertEqual(registry.cache_hits, 0)
+        self.assertEqual(registry.cache_misses, 0)
+
     def test_unknown_predicate(self):
         from happy.view import ViewRegistry
         from webob import Request
@@ -100,5 +329,35 @@ class TestViewRegistry(unittest.TestCase):
         registry = ViewRegistry()
         self.assertRaises(ValueError, registry.register, 'view', foo='foo')
 
+class TestCallingConvention(unittest.TestCase):
+    def test_calling_convention(self):
+        from happy.view import calling_convention
+        from happy.view import REQUEST_ONLY
+        from happy.view import REQUEST_AND_ARGS
+
+        def request_only(request):
+            pass
+        def with_context(request, context):
+            pass
+        def with_kw(request, **kw):
+            pass
+        class View(object):
+            def __init__(self, request):
+                pass
+            def __call__(self, request):
+                pass
+            def method(self, request, context):
+                pass
+
+        f = calling_convention
+        self.assertEqual(f(request_only), REQUEST_ONLY)
+        self.assertEqual(f(with_context), REQUEST_AND_ARGS)
+        self.assertEqual(f(with_kw), REQUEST_AND_ARGS)
+        self.assertEqual(f(lambda request=None: None), REQUEST_ONLY)
+        self.assertEqual(f(View), REQUEST_ONLY)
+        self.assertEqual(f(View(None)), REQUEST_ONLY)
+        self.assertEqual(f(View(None).method), REQUEST_AND_ARGS)
+        self.assertEqual(f(dict), REQUEST_AND_ARGS)
+
 class Dummy(object):
     pass
@@ -45,6 +45,18 @@ and may contain other models.  A model without the ``__getitem__`` method is,
 necessarily, a leaf node.  This is the only contract expected of models in
 order to be traversable.
 
+When traversing with ``prefetch`` enabled, a container may, optionally, also
+implement a ``__traverse_many__`` method, which is passed the list of all
+remaining path segments and returns a list of the models found by traversing
+as many of them as it can, in order.  A container which loads its contents
+from a database, for instance, might use this to fetch a whole chain of
+models in a single query, rather than making a round trip for each segment.
+Traversal continues, from the last model returned, with any segments which
+were not consumed.  An empty list means that the first segment could not be
+found.  Containers which don't implement ``__traverse_many__`` are traversed
+using ``__getitem__``.  Checking for the hook has a cost, so ``prefetch`` is
+disabled by default.
+
 In order for anything interesting to happen, models must be mapped to
 conrollers in some way. For information on mapping models to views, see
 the ``TraversalDispatcher`` class.
@@ -52,41 +64,247 @@ the ``TraversalDispatcher`` class.
 """
 # XXX Update docs to include move to a ViewRegistry.
 
+from happy.request import application_url
+from happy.request import scoped_request
+from happy.view import REQUEST_ONLY
 from happy.view import ViewRegistry
+from happy.view import calling_convention
+import time
 import webob
 
-def traverse(root, path):
+def traverse(root, path, cache=None, prefetch=False):
     """
     Traverses object graph starting at ``root`` using ``path``.  Returns the
     tuple: ``(context, subpath)`` where ``context`` is the object found
     as a result of the traversal and ``subpath`` is a list of the path
     segments that were not used by the traversal, ie the path segements which
     follow the segment that corresponds to the context.
+
+    An instance of ``TraversalCache`` may optionally be passed as ``cache``,
+    in which case traversal starts from the deepest previously resolved
+    model along ``path``, rather than from ``root``.
+
+    If ``prefetch`` is true, containers which implement ``__traverse_many__``
+    are asked to resolve the remaining segments at once.  Otherwise only
+    ``__getitem__`` is used, which is faster when no container implements the
+    hook.
     """
     path = filter(None, path.split('/'))
+    n_segments = len(path)
     node = root
-    while path:
-        if not hasattr(node, '__getitem__'):
+    i = 0
+    if cache is not None:
+        node, i = cache.lookup(root, path)
+
+    if prefetch:
+        for i, node in _walk(node, path, i):
+            if cache is not None:
+                cache.store(root, path[:i], node)
+        return node, path[i:]
+
+    while i < n_segments:
+        getitem = getattr(node, '__getitem__', None)
+        if getitem is None:
             break
 
-        next = path.pop(0)
         try:
-            node = node.__getitem__(next)
+            node = getitem(path[i])
         except KeyError:
-            path.insert(0, next)
             break
 
-    return node, path
+        i += 1
+        if cache is not None:
+            cache.store(root, path[:i], node)
+
+    return node, path[i:]
+
+_marker = object()
+
+def _walk(node, path, i):
+    """
+    Generates ``(i, model)`` for each model resolved from ``node`` by
+    traversing the segments of ``path`` from index ``i`` onwards, where ``i``
+    is the number of segments consumed so far.  Models with a
+    ``__traverse_many__`` hook are asked to resolve as many of the remaining
+    segments as they can at once, otherwise segments are resolved one at a
+    time using ``__getitem__``.  Used when traversing with ``prefetch``.
+    """
+    n_segments = len(path)
+    while i < n_segments:
+        cls = node.__class__
+        hook = _traverse_many_hooks.get(cls, _marker)
+        if hook is _marker:
+            hook = getattr(cls, '__traverse_many__', None)
+            _traverse_many_hooks[cls] = hook
+        if hook is not None:
+            nodes = hook(node, path[i:])
+            if not nodes:
+                return
+
+            for node in nodes:
+                i += 1
+                yield i, node
+            continue
+
+        getitem = getattr(node, '__getitem__', None)
+        if getitem is None:
+            return
 
-def find_model(root, path):
+        try:
+            node = getitem(path[i])
+        except KeyError:
+            return
+
+        i += 1
+        yield i, node
+
+# Looking up the __traverse_many__ hook on each model is relatively expensive
+# when, as for most models, it is missing, so hooks are looked up once per
+# class.
+_traverse_many_hooks = {}
+
+def traverse_many(root, paths, prefetch=False):
+    """
+    Traverses object graph starting at ``root`` for each path in the iterable,
+    ``paths``.  Returns a list of ``(context, subpath)`` tuples, in the same
+    order as ``paths``, as would be returned by calling ``traverse`` for each
+    path, with the same value for ``prefetch``.  Models found along the way
+    are remembered by path prefix, so that models along a prefix shared by
+    several paths are only looked up once.  Useful when resolving large
+    numbers of paths at once, such as when generating a sitemap.
+    """
+    resolved = {(): root}
+    results = []
+    for path in paths:
+        path = filter(None, path.split('/'))
+        n_segments = len(path)
+
+        # Find the longest prefix of path which has already been resolved.
+        i = n_segments
+        prefix = tuple(path)
+        node = resolved.get(prefix, _marker)
+        while node is _marker:
+            i -= 1
+            prefix = prefix[:i]
+            node = resolved.get(prefix, _marker)
+
+        if prefetch:
+            for i, node in _walk(node, path, i):
+                resolved[tuple(path[:i])] = node
+            results.append((node, path[i:]))
+            continue
+
+        while i < n_segments:
+            getitem = getattr(node, '__getitem__', None)
+            if getitem is None:
+                break
+
+            try:
+                node = getitem(path[i])
+            except KeyError:
+                break
+
+            i += 1
+            resolved[tuple(path[:i])] = node
+
+        results.append((node, path[i:]))
+
+    return results
+
+def find_model(root, path, cache=None, prefetch=False):
     """
     Same as `traverse` but raises `KeyError` if entire path is not consumed.
     """
-    model, subpath = traverse(root, path)
+    model, subpath = traverse(root, path, cache, prefetch)
     if subpath:
         raise KeyError('%s has no key: %s' % (model, subpath[0]))
     return model
 
+class TraversalCache(object):
+    """
+    Caches the models resolved by `traverse`, keyed on the identity of the
+    root and the path segments leading to each model, so that models along a
+    commonly traversed path, which might be expensive to load from a
+    persistent store, are not looked up again on every request::
+
+        cache = TraversalCache(ttl=60)
+        context, subpath = traverse(root, request.path_info, cache)
+
+    Only successful lookups are cached.  Cached models are returned until they
+    are older than `ttl` seconds, if given, or until the cache is
+    invalidated.  Applications are responsible for calling `invalidate` when
+    models are added, moved or removed.  Once `max_size` models have been
+    cached, the cache is cleared.
+
+    A cache may be shared between threads.  Note, though, that since models
+    are kept in the cache and returned for later requests, a cache should
+    only be used for models which are not bound to a particular request or
+    connection to a persistent store.
+    """
+    _now = time.time
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache = {}
+
+    def lookup(self, root, path):
+        """
+        Returns the tuple ``(model, n)`` for the deepest cached model along
+        ``path``, a list of path segments, where ``n`` is the number of
+        segments consumed.  Returns ``(root, 0)`` if nothing is cached.
+        """
+        cache = self._cache
+        if cache:
+            root_id = id(root)
+            now = self.ttl is not None and self._now()
+            for i in xrange(len(path), 0, -1):
+                key = (root_id, tuple(path[:i]))
+                entry = cache.get(key)
+                if entry is None:
+                    continue
+
+                model, expires = entry[:2]
+                if expires is not None and expires <= now:
+                    # Another thread may have already removed the entry.
+                    cache.pop(key, None)
+                    continue
+                return model, i
+
+        return root, 0
+
+    def store(self, root, path, model):
+        """
+        Caches ``model`` as the result of traversing ``path``, a list of path
+        segments, from ``root``.
+        """
+        cache = self._cache
+        if len(cache) >= self.max_size:
+            cache.clear()
+
+        expires = None
+        if self.ttl is not None:
+            expires = self._now() + self.ttl
+        # The root is kept in the entry so that its id can't be reused by
+        # another object while the entry is cached.
+        cache[(id(root), tuple(path))] = (model, expires, root)
+
+    def invalidate(self, path=None):
+        """
+        Removes the model at ``path`` and any models below it from the cache,
+        for all roots.  If no path is given, the cache is cleared.
+        """
+        if path is None:
+            self._cache.clear()
+            return
+
+        prefix = tuple(filter(None, path.split('/')))
+        n = len(prefix)
+        cache = self._cache
+        for key in cache.keys():
+            if key[1][:n] == prefix:
+                cache.pop(key, None)
+
 class TraversalDispatcher(object):
     """
     An instance of ``TraversalDispatcher`` dispatches a request to a view
@@ -97,7 +315,9 @@ class TraversalDispatcher(object):
 
         view(request, context)
 
-    Where context is the result of the traversal.  Views are registered
+    Where context is the result of the traversal.  Views which only accept a
+    request are called as ``view(request)`` and may find the context as the
+    ``context`` attribute of the request.  Views are registered
     by type (class) and optionally, a view name.  If the result of
     calling ``traverse`` returns a non-empty subpath, the first element of the
     subpath is considered to be the view name and a view is looked
@@ -136,6 +356,17 @@ class TraversalDispatcher(object):
     this is usually not useful without also subclassing
     ``TraversalDispatcher``.
 
+    The constructor also accepts an optional `traversal_cache` argument, an
+    instance of ``TraversalCache``, which is passed to ``traverse`` so that
+    models along commonly requested paths aren't looked up again for every
+    request.  The same cache is used for every request handled by the
+    dispatcher, across threads, so it should only be used when models are not
+    bound to a particular request or connection to a persistent store, for
+    instance when the root factory returns the same, long lived, object graph
+    for every request.  Passing `prefetch=True` enables the
+    ``__traverse_many__`` hook, described above, for containers which can
+    load a chain of models at once.
+
     For advanced users that want to subsitute their own means of looking up
     views for a context, ``TraversalDispatcher`` is designed to be
     subclassed.  Overriding the ``_lookup_view`` method, a subclass can
@@ -149,15 +380,20 @@ class TraversalDispatcher(object):
     """
     Request = webob.Request
 
-    def __init__(self, root_factory, registry=None):
+    def __init__(self, root_factory, registry=None, traversal_cache=None,
+                 prefetch=False):
         self.root_factory = root_factory
         if registry == None:
             registry = ViewRegistry()
         self._registry = registry
+        self.traversal_cache = traversal_cache
+        self.prefetch = prefetch
+        self._conventions = {}
 
     def __call__(self, request):
         root = self.root_factory(request)
-        context, subpath = traverse(root, request.path_info)
+        context, subpath = traverse(
+            root, request.path_info, self.traversal_cache, self.prefetch)
         name = None
         if subpath:
             name = subpath.pop(0)
@@ -166,39 +402,107 @@ class TraversalDispatcher(object):
             subpath.insert(0, name)
             view = self._lookup_view(request, context)
         if view is not None:
-            request = self.Request(request.environ.copy())
+            request = scoped_request(request, self.Request)
             request.context = context
             request.root = root
             request.subpath = subpath
+            if self._calling_convention(view) is REQUEST_ONLY:
+                return view(request)
             return view(request, context)
 
     def register(self, view, klass=None, name=None, **predicates):
         self._registry.register(view, klass, name, **predicates)
+        # The view is kept along with its convention so that its id can't be
+        # reused by another object.
+        self._conventions[id(view)] = (view, calling_convention(view))
+
+    def _calling_convention(self, view):
+        # Views registered by other means, for instance directly with a
+        # registry passed to the constructor, are inspected on each call.
+        entry = self._conventions.get(id(view))
+        if entry is not None:
+            return entry[1]
+        return calling_convention(view)
+
+    def freeze(self):
+        """
+        Freezes the view registry, for faster view lookups, once all views
+        have been registered.  See ``happy.registry.Registry.freeze``.
+        """
+        self._registry.freeze()
 
     def _lookup_view(self, request, context, name=None):
         return self._registry.lookup(request, context, name)
 
-def model_path(context, *subpath):
+def model_path(context, *subpath, **kw):
     """
     Construct the path to this model starting from the root of the object
     graph.
+
+    A dict may optionally be passed as the `memo` keyword argument, in which
+    case the paths of the model and its ancestors are remembered in the dict,
+    keyed by object identity.  Passing the same memo, for the duration of a
+    single request, when generating paths for many models, such as the
+    contents of a folder, allows them to share the already computed paths of
+    their common ancestors.
     """
-    def visit(node):
-        if hasattr(node, '__parent__'):
-            for parent in visit(node.__parent__):
-                yield parent
-        yield getattr(node, '__name__', '')
-    path = list(visit(context))
+    memo = kw.pop('memo', None)
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw))
+
+    if memo is None:
+        path = _model_path(context)
+    else:
+        path = _memoized_model_path(context, memo)
+
     if subpath:
-        path.extend(subpath)
+        return '/'.join((path,) + subpath)
     elif hasattr(context, '__getitem__'):
         # Folderish
-        path.append('')
-    return '/'.join(path)
-
-def model_url(request, context, *subpath):
-    path = model_path(context, *subpath)
-    return '%s/%s' % (
-        request.application_url.rstrip('/'),
-        path.lstrip('/')
-    )
+        return path + '/'
+    return path
+
+def _model_path(context):
+    names = []
+    node = context
+    while hasattr(node, '__parent__'):
+        names.append(getattr(node, '__name__', ''))
+        node = node.__parent__
+    names.append(getattr(node, '__name__', ''))
+    names.reverse()
+    return '/'.join(names)
+
+def _memoized_model_path(context, memo):
+    # Find the nearest ancestor whose path is already known
+    path = None
+    unknown = []
+    node = context
+    while True:
+        known = memo.get(id(node))
+        if known is not None:
+            path = known[1]
+            break
+        unknown.append(node)
+        if not hasattr(node, '__parent__'):
+            break
+        node = node.__parent__
+
+    # The node is kept in the memo so that its id can't be reused by another
+    # object while the memo is in use.
+    for node in reversed(unknown):
+        name = getattr(node, '__name__', '')
+        if path is None:
+            path = name
+        else:
+            path = path + '/' + name
+        memo[id(node)] = (node, path)
+
+    return path
+
+def model_url(request, context, *subpath, **kw):
+    """
+    Construct the URL for a model.  Accepts an optional `memo`, as for
+    `model_path`.
+    """
+    path = model_path(context, *subpath, **kw)
+    return '%s/%s' % (application_url(request), path.lstrip('/'))
@@ -16,24 +16,137 @@ signatures::
         context = request.context
 
 Happy dispatchers which might dispatch to views know about both signatures
-and can figure out how to call a particular view appropriately.
+and can figure out how to call a particular view appropriately, using
+`calling_convention`.
 """
 
+import inspect
+
 from happy.registry import Registry
 from happy.registry import SimpleAxis
 from happy.registry import TypeAxis
 
+REQUEST_ONLY = 'request_only'
+REQUEST_AND_ARGS = 'request_and_args'
+
+def calling_convention(target):
+    """
+    Returns the calling convention for a view, controller or other target of
+    dispatch: `REQUEST_ONLY` if the target accepts only a single, request,
+    argument or `REQUEST_AND_ARGS` if it accepts further arguments, such as
+    the context of a view or the match elements of a route.  A dispatcher
+    can then call the target directly with the arguments it expects.
+
+    Inspecting the target's signature is relatively expensive, so
+    dispatchers should determine the convention once, when the target is
+    registered, rather than for every request.  Targets whose signatures
+    can't be inspected are assumed to accept further arguments.
+    """
+    skip = 0 # Number of bound arguments, ie 'self'
+    if inspect.isfunction(target):
+        func = target
+    elif inspect.ismethod(target):
+        func = target
+        if target.im_self is not None:
+            skip = 1
+    elif inspect.isclass(target):
+        func = target.__init__
+        skip = 1
+    else:
+        func = getattr(target, '__call__', None)
+        skip = 1
+
+    try:
+        args, varargs, keywords, defaults = inspect.getargspec(func)
+    except TypeError:
+        return REQUEST_AND_ARGS
+
+    if len(args) - skip == 1 and not (varargs or keywords):
+        return REQUEST_ONLY
+    return REQUEST_AND_ARGS
+
 class _PredicatesAxis(object):
-    def matches(self, request, keys):
-        keys = list(keys) # copy
+    """
+    Matches requests against the sets of predicates registered with a view
+    registry.  Predicate sets are kept sorted from most to least specific,
+    where more predicates is more specific and, for the same number of
+    predicates, earlier registrations come first.  Sorted predicate sets are
+    further indexed by request method, so that sets which require a
+    different request method are never evaluated.
+    """
+    def __init__(self):
+        self._sorted = []
+        self._by_method = {}
+        self._any_method = ()
+        self._tests_by_method = {}
+        self._any_method_tests = ()
 
-        # Sort by number of predicates
-        keys.sort(key=lambda x: len(x), reverse=True)
+    def add(self, predicates):
+        """
+        Called by the view registry for each set of predicates registered.
+        """
+        sorted_predicates = self._sorted
+        if predicates in sorted_predicates:
+            return # Override of existing registration
+
+        n = len(predicates)
+        i = len(sorted_predicates)
+        while i and len(sorted_predicates[i - 1]) < n:
+            i -= 1
+        sorted_predicates.insert(i, predicates)
+        self._reindex()
+
+    def _reindex(self):
+        methods = set()
+        for predicates in self._sorted:
+            method = predicates.get('request_method')
+            if method is not None:
+                methods.add(method)
+
+        self._any_method = self._bucket(None)
+        self._any_method_tests = self._bucket_tests(self._any_method)
+        self._by_method = by_method = {}
+        self._tests_by_method = tests_by_method = {}
+        for method in methods:
+            bucket = by_method[method] = self._bucket(method)
+            tests_by_method[method] = self._bucket_tests(bucket)
+
+    def _bucket(self, method):
+        return tuple([
+            predicates for predicates in self._sorted
+            if predicates.get('request_method', method) == method
+        ])
 
-        # More predicates is more specific
-        # XXX Match order for same number of predicates is undefined.
-        for predicates in keys:
-            if predicates.match(request):
+    def _bucket_tests(self, bucket):
+        """
+        Returns the distinct tests, other than request method, used by the
+        predicates in a bucket, or `None` if any of them is not cacheable.
+        """
+        tests = {}
+        for predicates in bucket:
+            if not predicates.cacheable:
+                return None
+            for key, test in predicates.named_tests:
+                if key[0] != 'request_method':
+                    tests.setdefault(key, test)
+        return tuple([tests[key] for key in sorted(tests)])
+
+    def cache_key(self, request):
+        """
+        Results of matching depend only on the request method and the outcome
+        of each test registered for the request method.  Requests for methods
+        with uncacheable predicates are not cached.
+        """
+        method = request.method
+        tests = self._tests_by_method.get(method, self._any_method_tests)
+        if tests is None:
+            return None
+        return method, tuple([test(request) for test in tests])
+
+    def matches(self, request, keys):
+        bucket = self._by_method.get(request.method, self._any_method)
+        for predicates in bucket:
+            if predicates in keys and predicates.match(request):
                 yield predicates
 
 class ViewRegistry(Registry):
@@ -44,11 +157,15 @@ class ViewRegistry(Registry):
     """
     A registry which allows registration and lookup of views based on the
     type of the context object, certain aspects of the HTTP request, and/or
-    a view name.
+    a view name.  Where more than one set of predicates matches a request,
+    the set with the most predicates wins, with ties going to the earliest
+    registration.
     """
     def __init__(self):
+        self._predicate_types = dict(_default_predicate_types)
+        self._predicates_axis = self.PredicatesAxis()
         super(ViewRegistry, self).__init__(
-            ('request', self.PredicatesAxis()),
+            ('request', self._predicates_axis),
             ('context', self.TypeAxis()),
             ('name', self.SimpleAxis()),
         )
@@ -68,19 +185,30 @@ class ViewRegistry(Registry):
           `request_param`: Name of a request parameter that must be present to
                            match, or 'name=value' expression where request
                            parameter, name, must be present and match value.
+                           The query string is checked first and the request
+                           body is only parsed if the parameter isn't found
+                           there.
+          `query_param`: Same as `request_param` but only checks the query
+                         string.  Never causes the request body to be parsed.
+          `post_param`: Same as `request_param` but only checks the request
+                        body.
           `xhr`: True or False.  For True, there must be an X-Requested-With
                  header which equals 'XMLHttpRequest'.
 
-           XXX More to come.
+        Additional predicates may be defined using `add_predicate`.
         """
+        predicates = _Predicates(predicates, self._predicate_types)
         super(ViewRegistry, self).register(
-            view, _Predicates(predicates), context_type, name
+            view, predicates, context_type, name
         )
+        self._predicates_axis.add(predicates)
 
     def override(self, view, context_type=None, name=None, **predicates):
+        predicates = _Predicates(predicates, self._predicate_types)
         super(ViewRegistry, self).override(
-            view, _Predicates(predicates), context_type, name
+            view, predicates, context_type, name
         )
+        self._predicates_axis.add(predicates)
 
     def lookup(self, request, context, name=None):
         # Presents a domain specific method signature, but otherwise just calls
@@ -88,22 +216,76 @@ class ViewRegistry(Registry):
         return super(ViewRegistry, self).lookup(request, context, name)
 
     def get_registration(self, context_type=None, name=None, **predicates):
-        return super(ViewRegistry, self).lookup(
-            _Predicates(predicates), context_type, name
+        return super(ViewRegistry, self).get_registration(
+            _Predicates(predicates, self._predicate_types), context_type, name
         )
 
+    def add_predicate(self, name, factory, cost=5, cacheable=True):
+        """
+        Defines a new predicate which may be used when registering views.
+
+        Arguments::
+
+          `name`: The keyword argument used to pass the predicate's value to
+                  `register`.
+          `factory`: Called with the predicate's value at registration time
+                     and returns a test function which, called with a
+                     request, returns a boolean indicating whether the
+                     request matches.
+          `cost`: Relative cost of evaluating the test.  When matching a
+                  request, tests are evaluated from cheapest to most
+                  expensive, so non-matching views are rejected as cheaply as
+                  possible.  The built in predicates have costs of 0 for
+                  `request_method`, 1 for `xhr`, 2 for `query_param` and 10
+                  for `request_param` and `post_param`, which may require
+                  parsing of the request body.
+          `cacheable`: Whether the outcome of the test may be used in the
+                       key for caching view lookups.  Computing the key
+                       requires evaluating every cacheable test registered
+                       for a request method, so pass `False` for tests which
+                       are expensive enough that they should only be
+                       evaluated when needed.  The built in `request_param`
+                       and `post_param` predicates are not cacheable, so
+                       that the request body is never parsed just to compute
+                       a cache key.
+
+        For example, to look up views by host name::
+
+          def host_predicate(host):
+              def test(request):
+                  return request.host == host
+              return test
+
+          registry.add_predicate('host', host_predicate, cost=1)
+          registry.register(view, Site, host='example.com')
+        """
+        if name in self._predicate_types:
+            raise ValueError('Predicate already defined: %s' % name)
+        self._predicate_types[name] = _PredicateType(factory, cost, cacheable)
+
 class _Predicates(dict):
-    known_predicates = set([
-        'request_method',
-        'request_param',
-        'xhr',
-    ])
-
-    def __init__(self, d): # Initialize from dict
-        for k in d:
-            if k not in self.known_predicates:
+    """
+    A set of predicates, stored as a dict of predicate name to value.  On
+    construction each predicate is compiled into a test function, so matching
+    a request is just a matter of calling each test in turn, from cheapest to
+    most expensive.
+    """
+    def __init__(self, d, predicate_types): # Initialize from dict
+        tests = []
+        cacheable = True
+        for k, v in d.items():
+            predicate_type = predicate_types.get(k)
+            if predicate_type is None:
                 raise ValueError('Unkown predicate: %s' % k)
+            tests.append(
+                (predicate_type.cost, k, v, predicate_type.factory(v)))
+            cacheable = cacheable and predicate_type.cacheable
+        tests.sort(key=lambda x: x[:2])
+
         super(_Predicates, self).__init__(d)
+        self._tests = tuple([test for cost, k, v, test in tests])
+        self.named_tests = tuple([((k, v), test) for cost, k, v, test in tests])
+        self.cacheable = cacheable
 
     def __hash__(self):
         h = 0
@@ -112,21 +294,70 @@ class _Predicates(dict):
         return h
 
     def match(self, request):
-        for name, value in self.items():
-            matcher = getattr(self, '_match_%s' % name)
-            if not matcher(request, value):
+        for test in self._tests:
+            if not test(request):
                 return False
         return True
 
-    def _match_request_method(self, request, value):
-        return request.method == value
+class _PredicateType(object):
+    def __init__(self, factory, cost, cacheable):
+        self.factory = factory
+        self.cost = cost
+        self.cacheable = cacheable
+
+def _request_method_predicate(method):
+    def test(request):
+        return request.method == method
+    return test
+
+def _request_param_predicate(param):
+    # Only consult the request body, parsing it if need be, when the
+    # parameter isn't in the query string.
+    return _param_predicate(param, (_query_vars, _post_vars))
+
+def _query_param_predicate(param):
+    return _param_predicate(param, (_query_vars,))
+
+def _post_param_predicate(param):
+    return _param_predicate(param, (_post_vars,))
+
+def _param_predicate(param, sources):
+    if '=' in param:
+        name, value = param.split('=', 1)
+        def test(request):
+            for source in sources:
+                params = source(request)
+                if name in params:
+                    return params[name] == value
+            return False
+    else:
+        def test(request):
+            for source in sources:
+                if param in source(request):
+                    return True
+            return False
+    return test
+
+def _query_vars(request):
+    return request.GET
+
+def _post_vars(request):
+    # WebOb caches the parsed body in the environ, so it is only parsed once
+    # per request, no matter how many predicates are tested.
+    return request.POST
+
+def _xhr_predicate(value):
+    def test(request):
+        return _is_xhr(request) == value
+    return test
 
-    def _match_request_param(self, request, param):
-        if '=' in param:
-            name, value = param.split('=')
-            return request.params.get(name, None) == value
-        return param in request.params
+def _is_xhr(request):
+    return request.headers.get('X-Requested-With', None) == 'XMLHttpRequest'
 
-    def _match_xhr(self, request, value):
-        xrw = request.headers.get('X-Requested-With', None)
-        return (xrw == 'XMLHttpRequest') == value
+_default_predicate_types = {
+    'request_method': _PredicateType(_request_method_predicate, 0, True),
+    'xhr': _PredicateType(_xhr_predicate, 1, True),
+    'request_param': _PredicateType(_request_param_predicate, 10, False),
+    'query_param': _PredicateType(_query_param_predicate, 2, True),
+    'post_param': _PredicateType(_post_param_predicate, 10, False),
+}